@@ -1,9 +1,11 @@
-import csv
 import os
 import sys
 import tkinter as tk
 from tkinter import ttk, messagebox
 
+from search_index import MemoryStore, read_csv_as_dicts
+from sqlite_store import SqliteStore, default_db_path, ensure_store
+
 APP_TITLE = "Specified Allowable Concentration Search System"
 
 # Dataset dropdown
@@ -23,14 +25,11 @@ DISPLAY_COLUMNS = [
     "เงื่อนไข",
 ]
 
-# Search only these columns
-SEARCH_COLUMNS = [
-    "Name of Common Ingredients Glossary",
-    "CAS Number",
-]
-
 MAX_SHOW = 600
 
+# Grouped view: the parent row of a substance shows only what its variants share
+GROUP_SUMMARY_COLUMNS = ("Name of Common Ingredients Glossary", "CAS Number")
+
 # Truncate long text in table for readability
 TRUNCATE_LIMIT = {
     "Chemical Name/ Other Name": 52,
@@ -50,7 +49,7 @@ COLUMN_WIDTH = {
     "เงื่อนไข": 520,
 }
 
-PLACEHOLDER = "พิมพ์ชื่อสามัญ (Common) หรือ CAS เช่น 101-20-2 …"
+PLACEHOLDER = "พิมพ์ชื่อสามัญ (Common) หรือ CAS เช่น 101-20-2 … หรือ cas:65-85-0 conc>1 NOT chem:sodium"
 
 
 def normalize(s):
@@ -65,27 +64,9 @@ def truncate_text(s, limit):
     return s
 
 
-def read_csv_as_dicts(path):
-    for enc in ("utf-8-sig", "utf-8", "cp874"):
-        try:
-            with open(path, "r", encoding=enc, newline="") as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
-                headers = reader.fieldnames or []
-            return headers, rows
-        except UnicodeDecodeError:
-            continue
-    raise RuntimeError("อ่านไฟล์ไม่ได้: %s" % path)
-
-
-def contains_match(row, query, cols):
-    q = normalize(query)
-    if not q:
-        return True
-    for c in cols:
-        if q in normalize(str(row.get(c, ""))):
-            return True
-    return False
+def display_value(v):
+    s = "" if v is None else str(v)
+    return s if s.strip() else "-"
 
 
 class App(tk.Tk):
@@ -123,10 +104,19 @@ class App(tk.Tk):
 
         # --- Data ---
         self.headers_by_ds = []
-        self.rows_by_ds = []
-        self.last_shown_rows = []
+        # rows + indexes of all datasets (MemoryStore, or SqliteStore with SEARCH_DB)
+        self.store = None
+        # per-row display cache, filled the first time a row is shown (rows are immutable until reload)
+        self.detail_cache = {}
+        self.table_cache = {}
+        self.item_refs = {}
+        self.pending_children = {}
         self.current_display_cols = []
 
+        # --- Sort (click a column heading; click again to reverse) ---
+        self.sort_col = None
+        self.sort_reverse = False
+
         # --- Header (with FDA image) ---
         header = ttk.Frame(self, padding=(16, 14))
         header.pack(fill="x")
@@ -197,6 +187,17 @@ class App(tk.Tk):
 
         ttk.Button(controls, text="ล้าง", command=self.clear_search).grid(row=0, column=3, sticky="e")
 
+        # one expandable row per substance (CAS + Common), variants inserted on open
+        self.group_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            controls, text="จัดกลุ่มตามสาร", variable=self.group_var, command=self.apply_filter
+        ).grid(row=0, column=4, sticky="e", padx=(12, 0))
+
+        self.multi_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            controls, text="เฉพาะสารที่อยู่หลายบัญชี", variable=self.multi_var, command=self.apply_filter
+        ).grid(row=0, column=5, sticky="e", padx=(12, 0))
+
         self.status = ttk.Label(self, text="กำลังโหลดไฟล์...", style="Muted.TLabel")
         self.status.pack(fill="x", padx=18)
 
@@ -221,11 +222,11 @@ class App(tk.Tk):
         xscroll.grid(row=2, column=0, sticky="ew")
 
         self.tree.bind("<<TreeviewSelect>>", lambda e: self.show_detail())
+        self.tree.bind("<<TreeviewOpen>>", lambda e: self.expand_group())
 
         # RIGHT: detail card (narrower)
         detail_card = ttk.Frame(main, style="Card.TFrame", padding=12)
         detail_card.columnconfigure(1, weight=1)
-        detail_card.rowconfigure(8, weight=1)
 
         ttk.Label(detail_card, text="รายละเอียด", style="H2.TLabel").grid(row=0, column=0, sticky="w", columnspan=2)
 
@@ -237,6 +238,7 @@ class App(tk.Tk):
             ("กรณีที่ใช้", "กรณีที่ใช้"),
             ("Chemical", "Chemical Name/ Other Name"),
             ("ความเข้มข้นสูงสุด", "ความเข้มข้นสูงสุดในเครื่องสำอางพร้อมใช้ (%w/w)"),
+            ("อยู่ในบัญชีอื่นด้วย", "_also_in"),
         ]
 
         self.value_vars = {}
@@ -252,6 +254,7 @@ class App(tk.Tk):
             )
             r += 1
 
+        detail_card.rowconfigure(r, weight=1)
         ttk.Label(detail_card, text="เงื่อนไข", style="Muted.TLabel").grid(
             row=r, column=0, sticky="nw", pady=(10, 4), padx=(0, 10)
         )
@@ -302,35 +305,72 @@ class App(tk.Tk):
 
     # ---------- Data ----------
     def load_all(self):
-        self.headers_by_ds = []
-        self.rows_by_ds = []
-
-        # load real files (index 1,2 in DATASETS)
-        for name, fname in DATASETS[1:]:
-            path = os.path.join(self.base_dir, fname)
+        self.detail_cache = {}
+        self.table_cache = {}
+        self.store = None
+
+        # optional SQLite backend (SEARCH_DB=...): import once, then read only the rows shown
+        db_path = default_db_path(self.base_dir)
+        if db_path:
+            files = [(os.path.join(self.base_dir, fname), name) for name, fname in DATASETS[1:]]
             try:
-                headers, rows = read_csv_as_dicts(path)
+                ensure_store(db_path, files)
+                self.store = SqliteStore(db_path)
             except Exception as e:
                 messagebox.showerror("Error", str(e))
-                headers, rows = [], []
-            self.headers_by_ds.append(headers)
-            self.rows_by_ds.append(rows)
 
+        if self.store is None:
+            # load real files (index 1,2 in DATASETS)
+            datasets = []
+            for name, fname in DATASETS[1:]:
+                path = os.path.join(self.base_dir, fname)
+                try:
+                    headers, rows = read_csv_as_dicts(path)
+                except Exception as e:
+                    messagebox.showerror("Error", str(e))
+                    headers, rows = [], []
+                datasets.append((name, headers, rows))
+            self.store = MemoryStore(datasets)
+
+        self.headers_by_ds = [self.store.headers.get(name, []) for name, _ in DATASETS[1:]]
         self.apply_filter()
 
+    def build_detail(self, row):
+        values = []
+        for _, key in self._fields:
+            v = row.get(key, "")
+            if key == "_also_in":
+                v = ", ".join(v)
+            values.append(display_value(v))
+        return tuple(values), display_value(row.get("เงื่อนไข", ""))
+
+    def prefetch(self, gids):
+        # truncated Treeview tuples per column set + detail values, read from the store once per row
+        cols = tuple(self.current_display_cols)
+        table = self.table_cache.setdefault(cols, {})
+        missing = [g for g in gids if g not in table]
+        if not missing:
+            return
+        limits = [TRUNCATE_LIMIT.get(c) for c in cols]
+        for g, r in zip(missing, self.store.fetch(missing)):
+            table[g] = tuple(truncate_text(r.get(c, ""), limit) for c, limit in zip(cols, limits))
+            if g not in self.detail_cache:
+                self.detail_cache[g] = self.build_detail(r)
+
     def resolve_columns(self, headers):
-        display = [c for c in DISPLAY_COLUMNS if c in headers]
-        search = [c for c in SEARCH_COLUMNS if c in headers]
-        if not search:
-            search = display
-        return display, search
+        return [c for c in DISPLAY_COLUMNS if c in headers]
 
     def setup_columns(self, cols):
         self.tree["columns"] = cols
         for c in cols:
-            self.tree.heading(c, text=c)
+            text = c
+            if c == self.sort_col:
+                text = "%s %s" % (c, "▼" if self.sort_reverse else "▲")
+            self.tree.heading(c, text=text, command=lambda col=c: self.sort_by(col))
             w = COLUMN_WIDTH.get(c, 200)
             self.tree.column(c, width=w, stretch=True)
+        self.tree.heading("#0", text="")
+        self.tree.column("#0", width=90, stretch=False)
 
     def get_selected_indices(self):
         sel = self.ds_var.get()
@@ -340,6 +380,20 @@ class App(tk.Tk):
             return [0]
         return [1]
 
+    # ---------- Sort ----------
+    def sort_by(self, col):
+        if col == self.sort_col:
+            if self.sort_reverse:
+                # third click: back to file order
+                self.sort_col = None
+                self.sort_reverse = False
+            else:
+                self.sort_reverse = True
+        else:
+            self.sort_col = col
+            self.sort_reverse = False
+        self.apply_filter()
+
     # ---------- Realtime apply (debounce) ----------
     def apply_filter_realtime(self):
         if hasattr(self, "_after_id") and self._after_id:
@@ -361,46 +415,72 @@ class App(tk.Tk):
                 if h not in union_headers:
                     union_headers.append(h)
 
-        display_cols, _ = self.resolve_columns(union_headers)
+        display_cols = self.resolve_columns(union_headers)
         self.current_display_cols = display_cols
         self.setup_columns(display_cols)
 
-        raw_rows = []
-        total_rows = 0
-        total_match = 0
-
-        for idx in idx_list:
-            headers = self.headers_by_ds[idx]
-            rows = self.rows_by_ds[idx]
-            total_rows += len(rows)
-
-            _, search_cols = self.resolve_columns(headers)
-            filtered = [r for r in rows if contains_match(r, q, search_cols)]
-            total_match += len(filtered)
-
-            source_label = "วัตถุกันเสีย" if idx == 0 else "วัตถุอาจใช้เป็นส่วนผสม"
-            for r in filtered:
-                r2 = dict(r)
-                r2["_source"] = source_label
-                raw_rows.append(r2)
-
-        self.last_shown_rows = raw_rows[:MAX_SHOW]
+        sources = [DATASETS[idx + 1][0] for idx in idx_list]
+        total_rows = sum(self.store.counts.get(s, 0) for s in sources)
+        multi = self.multi_var.get()
 
         self.tree.delete(*self.tree.get_children())
-        for r in self.last_shown_rows:
-            vals = []
-            for c in self.current_display_cols:
-                limit = TRUNCATE_LIMIT.get(c)
-                vals.append(truncate_text(r.get(c, ""), limit))
-            self.tree.insert("", "end", values=vals)
-
-        if normalize(q):
-            self.status.config(text="พบ %s แถว (แสดง %s)" % (total_match, len(self.last_shown_rows)))
+        self.item_refs = {}
+        self.pending_children = {}
+
+        if self.group_var.get():
+            self.tree.configure(show="tree headings")
+            gids = self.store.select(q, sources, self.sort_col, self.sort_reverse, multi)
+            total_match = len(gids)
+            groups = self.store.groups(gids)
+            self.prefetch([members[0] for _, members in groups[:MAX_SHOW]])
+            for _, members in groups[:MAX_SHOW]:
+                if len(members) == 1:
+                    self.insert_row("", members[0])
+                    continue
+                iid = self.insert_summary(members)
+                self.pending_children[iid] = members
+                self.tree.insert(iid, "end")  # placeholder so the row can be opened
+            shown = "%s สาร" % min(len(groups), MAX_SHOW)
+        else:
+            self.tree.configure(show="headings")
+            # only the shown page is read from the store
+            total_match = self.store.count(q, sources, multi)
+            gids = self.store.page(q, sources, self.sort_col, self.sort_reverse, multi, 0, MAX_SHOW)
+            self.prefetch(gids)
+            for g in gids:
+                self.insert_row("", g)
+            shown = len(gids)
+
+        if normalize(q) or multi:
+            self.status.config(text="พบ %s แถว (แสดง %s)" % (total_match, shown))
         else:
             self.status.config(text="โหลดแล้ว %s แถว — พิมพ์ Common หรือ CAS เพื่อค้นหา" % total_rows)
 
         self._clear_detail()
 
+    def insert_row(self, parent, gid, text=""):
+        values = self.table_cache[tuple(self.current_display_cols)][gid]
+        iid = self.tree.insert(parent, "end", text=text, values=values)
+        self.item_refs[iid] = gid
+        return iid
+
+    def insert_summary(self, members):
+        # every variant is a child row; the parent carries no concentration or condition of its own
+        cols = self.current_display_cols
+        first = self.table_cache[tuple(cols)][members[0]]
+        values = tuple(v if c in GROUP_SUMMARY_COLUMNS else "" for c, v in zip(cols, first))
+        return self.tree.insert("", "end", text="%s แบบ" % len(members), values=values)
+
+    def expand_group(self):
+        iid = self.tree.focus()
+        members = self.pending_children.pop(iid, None)
+        if not members:
+            return
+        self.tree.delete(*self.tree.get_children(iid))
+        self.prefetch(members)
+        for g in members:
+            self.insert_row(iid, g)
+
     # ---------- Detail ----------
     def _clear_detail(self):
         for var in self.value_vars.values():
@@ -410,28 +490,26 @@ class App(tk.Tk):
         self.condition_text.insert("1.0", "-")
         self.condition_text.configure(state="disabled")
 
-    def get_selected_row(self):
+    def get_selected_gid(self):
         sel = self.tree.selection()
         if not sel:
             return None
-        i = self.tree.index(sel[0])
-        if 0 <= i < len(self.last_shown_rows):
-            return self.last_shown_rows[i]
-        return None
+        return self.item_refs.get(sel[0])
 
     def show_detail(self):
-        row = self.get_selected_row()
-        if not row:
+        gid = self.get_selected_gid()
+        if gid is None:
+            # group summary row
+            self._clear_detail()
             return
+        values, cond = self.detail_cache[gid]
 
-        for _, key in self._fields:
-            v = row.get(key, "")
-            self.value_vars[key].set(v if str(v).strip() else "-")
+        for (_, key), v in zip(self._fields, values):
+            self.value_vars[key].set(v)
 
-        cond = row.get("เงื่อนไข", "")
         self.condition_text.configure(state="normal")
         self.condition_text.delete("1.0", "end")
-        self.condition_text.insert("1.0", cond if str(cond).strip() else "-")
+        self.condition_text.insert("1.0", cond)
         self.condition_text.configure(state="disabled")
 
 
@@ -0,0 +1,700 @@
+"""Local HTTP JSON lookup service over the same indexes as app.py / streamlit_app.py.
+
+    python lookup_service.py serve [--host 127.0.0.1] [--port 8765] [--workers 8]
+    python lookup_service.py bench [--url http://127.0.0.1:8765] [-n 2000] [-c 8] [query ...]
+
+Endpoints (query syntax as in the apps, e.g. cas:65-85-0 conc>1):
+
+    GET  /lookup?q=...&dataset=all|preservatives|allowed&limit=50&sort=conc&desc=1
+    POST /batch   {"queries": ["...", ...], "dataset": "all", "limit": 50}
+    GET  /health
+    GET  /metrics
+
+Set SEARCH_DB=<path> to search through the SQLite store (see sqlite_store.py).
+"""
+
+import argparse
+import collections
+import http.client
+import json
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from search_index import (
+    ALSO_IN_FIELD,
+    COL_CAS,
+    COL_CHEM,
+    COL_COMMON,
+    COL_COND,
+    COL_MAXC,
+    COL_ORDER,
+    COL_USECASE,
+    SOURCE_FIELD,
+    MemoryStore,
+    read_csv_as_dicts,
+    text_of,
+)
+from sqlite_store import SqliteStore, default_db_path, ensure_store
+
+COL_AREA = "บริเวณที่ใช้ และ/หรือ การนำไปใช้"
+
+# ?dataset= -> (file, source label)
+DATASETS = collections.OrderedDict(
+    [
+        ("preservatives", ("preservatives.csv", "วัตถุกันเสีย")),
+        ("allowed", ("allowed.csv", "วัตถุอาจใช้เป็นส่วนผสม")),
+    ]
+)
+
+# JSON key -> column
+RESULT_FIELDS = [
+    ("order", COL_ORDER),
+    ("common", COL_COMMON),
+    ("cas", COL_CAS),
+    ("chem", COL_CHEM),
+    ("use", COL_USECASE),
+    ("area", COL_AREA),
+    ("max_concentration", COL_MAXC),
+    ("conditions", COL_COND),
+]
+
+# ?sort= -> column
+SORT_FIELDS = {
+    "order": COL_ORDER,
+    "common": COL_COMMON,
+    "cas": COL_CAS,
+    "chem": COL_CHEM,
+    "use": COL_USECASE,
+    "conc": COL_MAXC,
+}
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+MAX_BATCH = 500
+MAX_BODY = 1 << 20  # bytes
+BODY_TIMEOUT = 10  # seconds for the whole request body
+
+
+class BadRequest(Exception):
+    status = 400
+
+
+class PayloadTooLarge(BadRequest):
+    status = 413
+
+
+class RequestTimeout(BadRequest):
+    status = 408
+
+
+class LookupIndex(object):
+    """Lookups over a MemoryStore, or a SqliteStore with SEARCH_DB, loaded once.
+
+    A row's JSON is encoded the first time it is returned, so a response is
+    a join of cached byte fragments.
+    """
+
+    def __init__(self, base_dir):
+        db_path = default_db_path(base_dir)
+        files = [(os.path.join(base_dir, fname), source) for fname, source in DATASETS.values()]
+        if db_path:
+            ensure_store(db_path, files)
+            self.store = SqliteStore(db_path)
+        else:
+            datasets = []
+            for path, source in files:
+                try:
+                    headers, rows = read_csv_as_dicts(path)
+                except Exception as e:
+                    sys.stderr.write("skip %s: %s\n" % (path, e))
+                    headers, rows = [], []
+                datasets.append((source, headers, rows))
+            self.store = MemoryStore(datasets)
+        self.n = self.store.n
+        self.fragments = {}
+
+    def lookup(self, q, dataset="all", limit=DEFAULT_LIMIT, sort=None, desc=False):
+        if dataset not in ("all", None) and dataset not in DATASETS:
+            raise BadRequest("unknown dataset: %s" % dataset)
+        if sort is not None and sort not in SORT_FIELDS:
+            raise BadRequest("unknown sort field: %s" % sort)
+        limit = max(0, min(int(limit), MAX_LIMIT))
+
+        sources = None if dataset in ("all", None) else [DATASETS[dataset][1]]
+        total = self.store.count(q, sources)
+        hits = self.store.page(q, sources, SORT_FIELDS.get(sort), desc, limit=limit)
+        return total, hits
+
+    def fragments_of(self, ids):
+        cache = self.fragments
+        missing = [p for p in ids if p not in cache]
+        if missing:
+            for p, r in zip(missing, self.store.fetch(missing)):
+                item = collections.OrderedDict([("source", r[SOURCE_FIELD]), ("also_in", list(r[ALSO_IN_FIELD]))])
+                for key, col in RESULT_FIELDS:
+                    item[key] = text_of(r.get(col))
+                cache[p] = json.dumps(item, ensure_ascii=False).encode("utf-8")
+        return [cache[p] for p in ids]
+
+    def render(self, q, total, hits):
+        head = json.dumps({"query": q, "total": total}, ensure_ascii=False).encode("utf-8")
+        return b"".join(
+            [head[:-1], b', "results": [', b", ".join(self.fragments_of(hits)), b"]}"]
+        )
+
+    def lookup_json(self, q, dataset="all", limit=DEFAULT_LIMIT, sort=None, desc=False):
+        total, hits = self.lookup(q, dataset, limit, sort, desc)
+        return self.render(q, total, hits)
+
+
+class Metrics(object):
+    # per-endpoint request count, errors and latency percentiles (recent samples)
+
+    SAMPLES = 2048
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, endpoint, seconds, ok=True):
+        with self.lock:
+            s = self.stats.get(endpoint)
+            if s is None:
+                s = self.stats[endpoint] = {
+                    "count": 0,
+                    "errors": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "recent": collections.deque(maxlen=self.SAMPLES),
+                }
+            s["count"] += 1
+            if not ok:
+                s["errors"] += 1
+            s["total"] += seconds
+            s["max"] = max(s["max"], seconds)
+            s["recent"].append(seconds)
+
+    def snapshot(self):
+        out = {}
+        with self.lock:
+            for endpoint, s in self.stats.items():
+                recent = sorted(s["recent"])
+                out[endpoint] = {
+                    "count": s["count"],
+                    "errors": s["errors"],
+                    "mean_ms": round(1000.0 * s["total"] / s["count"], 4),
+                    "p50_ms": round(1000.0 * percentile(recent, 50), 4),
+                    "p95_ms": round(1000.0 * percentile(recent, 95), 4),
+                    "p99_ms": round(1000.0 * percentile(recent, 99), 4),
+                    "max_ms": round(1000.0 * s["max"], 4),
+                }
+        return out
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = int(round((len(sorted_values) - 1) * pct / 100.0))
+    return sorted_values[k]
+
+
+class ResponseCache(object):
+    """Hit lists of recent lookups, least recently used dropped past max_bytes.
+
+    Keys are normalized (q stripped, desc ignored without sort) and leave
+    out the limit: an entry answers every limit up to the ids it holds. It
+    keeps the body it was built with; other limits are joined from the
+    index's row fragments.
+    """
+
+    MAX_BYTES = 8 << 20
+    # rough size of one entry besides q, and of one id in its list
+    ENTRY_BYTES = 256
+    ID_BYTES = 40
+
+    def __init__(self, index, max_bytes=MAX_BYTES):
+        self.index = index
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.size = 0
+
+    def lookup_json(self, q, dataset="all", limit=DEFAULT_LIMIT, sort=None, desc=False):
+        q = (q or "").strip()
+        dataset = dataset or "all"
+        limit = max(0, min(int(limit), MAX_LIMIT))
+        if sort is None:
+            desc = False
+        key = (q, dataset, sort, desc)
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                self.items.move_to_end(key)
+        if entry is None or len(entry[1]) < min(limit, entry[0]):
+            total, hits = self.index.lookup(q, dataset, limit, sort, desc)
+            body = self.index.render(q, total, hits)
+            self.put(key, (total, hits, len(hits), body))
+            return body
+        total, hits, shown, body = entry
+        if min(limit, total) == shown:
+            return body
+        return self.index.render(q, total, hits[:limit])
+
+    def entry_size(self, key, entry):
+        return self.ENTRY_BYTES + len(key[0]) + self.ID_BYTES * len(entry[1]) + len(entry[3])
+
+    def put(self, key, entry):
+        size = self.entry_size(key, entry)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= self.entry_size(key, old)
+            self.items[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                k, e = self.items.popitem(last=False)
+                self.size -= self.entry_size(k, e)
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    server_version = "LookupService/1.0"
+    timeout = 10  # once a request has started, the rest must arrive within this
+    disable_nagle_algorithm = True  # headers and body are separate writes
+
+    def __init__(self, request, client_address, server):
+        # LookupServer drives the connection: one handle_one_request() per
+        # readable event on a pool worker, finish() when it is closed
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.close_connection = False
+        self.setup()
+
+    def has_buffered_request(self):
+        # pipelined bytes already in rfile never make the socket readable again
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/lookup":
+            self.handle_endpoint("lookup", lambda: self.get_lookup(parse_qs(url.query)))
+        elif url.path == "/health":
+            self.handle_endpoint("health", lambda: b'{"status": "ok", "rows": %d}' % self.server.index.n)
+        elif url.path == "/metrics":
+            self.handle_endpoint("metrics", lambda: json.dumps(self.server.metrics.snapshot()).encode("utf-8"))
+        else:
+            self.send_json(404, b'{"error": "not found"}')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path == "/batch":
+            self.handle_endpoint("batch", self.post_batch)
+        else:
+            self.discard_body()
+            self.send_json(404, b'{"error": "not found"}')
+
+    def handle_endpoint(self, name, build):
+        t0 = time.perf_counter()
+        try:
+            body = build()
+            status = 200
+        except BadRequest as e:
+            body = json.dumps({"error": str(e)}, ensure_ascii=False).encode("utf-8")
+            status = e.status
+        except Exception:
+            # details go to the log, not to the client
+            self.server.handle_error(self.request, self.client_address)
+            body = b'{"error": "internal error"}'
+            status = 500
+        self.server.metrics.record(name, time.perf_counter() - t0, status == 200)
+        self.send_json(status, body)
+
+    def get_lookup(self, params):
+        def one(name, default=None):
+            return params.get(name, [default])[0]
+
+        try:
+            limit = int(one("limit", DEFAULT_LIMIT))
+        except ValueError:
+            raise BadRequest("limit must be an integer")
+        args = (one("q", ""), one("dataset", "all"), limit, one("sort"), one("desc", "0") in ("1", "true"))
+        return self.server.cache.lookup_json(*args)
+
+    def content_length(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # the body cannot be skipped, so the connection cannot be reused
+            self.close_connection = True
+            raise BadRequest("bad Content-Length")
+        if length > MAX_BODY:
+            self.close_connection = True
+            raise PayloadTooLarge("body larger than %d bytes" % MAX_BODY)
+        return length
+
+    def read_body(self, keep=True):
+        # the whole body must arrive within BODY_TIMEOUT: the socket timeout
+        # only bounds each recv, so a trickling client could hold the worker
+        left = self.content_length()
+        deadline = time.monotonic() + BODY_TIMEOUT
+        parts = []
+        try:
+            while left > 0:
+                if time.monotonic() > deadline:
+                    raise socket.timeout()
+                chunk = self.rfile.read1(min(left, 65536))
+                if not chunk:
+                    self.close_connection = True
+                    raise BadRequest("incomplete body")
+                left -= len(chunk)
+                if keep:
+                    parts.append(chunk)
+        except socket.timeout:
+            self.close_connection = True
+            raise RequestTimeout("body not received within %d s" % BODY_TIMEOUT)
+        return b"".join(parts)
+
+    def discard_body(self):
+        # an unread body would be parsed as the next request on this keep-alive connection
+        try:
+            self.read_body(keep=False)
+        except BadRequest:
+            pass  # close_connection is set
+
+    def post_batch(self):
+        body = self.read_body()
+        try:
+            req = json.loads(body.decode("utf-8") or "{}")
+        except ValueError:
+            raise BadRequest("body must be JSON")
+        if not isinstance(req, dict):
+            raise BadRequest("body must be a JSON object")
+        queries = req.get("queries")
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            raise BadRequest('"queries" must be a list of strings')
+        if len(queries) > MAX_BATCH:
+            raise BadRequest("at most %d queries per batch" % MAX_BATCH)
+        try:
+            limit = int(req.get("limit", DEFAULT_LIMIT))
+        except (TypeError, ValueError):
+            raise BadRequest("limit must be an integer")
+        dataset = req.get("dataset", "all")
+        if not isinstance(dataset, str):
+            raise BadRequest('"dataset" must be a string')
+        sort = req.get("sort")
+        if sort is not None and not isinstance(sort, str):
+            raise BadRequest('"sort" must be a string')
+        desc = req.get("desc", False)
+        if not isinstance(desc, bool):
+            raise BadRequest('"desc" must be true or false')
+
+        cache = self.server.cache
+        parts = [cache.lookup_json(q, dataset, limit, sort, desc) for q in queries]
+        return b'{"results": [' + b", ".join(parts) + b"]}"
+
+    def send_json(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+class LookupServer(HTTPServer):
+    """HTTPServer that runs requests, not connections, on a fixed thread pool.
+
+    A selector loop owns the keep-alive connections and hands a connection
+    to a worker only when a request arrives; the worker gives it back after
+    the response. Idle clients hold no worker. Connections idle for
+    IDLE_TIMEOUT seconds are closed, and past MAX_CONNECTIONS the longest
+    idle one makes room for a new client.
+    """
+
+    IDLE_TIMEOUT = 30
+    MAX_CONNECTIONS = 1024
+    # listen backlog: socketserver's default of 5 drops SYNs of a connection burst (1 s retry)
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, address, index, workers=8, verbose=False):
+        HTTPServer.__init__(self, address, LookupHandler)
+        self.index = index
+        self.metrics = Metrics()
+        self.cache = ResponseCache(index)
+        self.verbose = verbose
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.socket.setblocking(False)  # _accept() drains the backlog until BlockingIOError
+
+        self.selector = selectors.DefaultSelector()
+        self.idle = collections.OrderedDict()  # handler -> idle since, longest idle first
+        self.open = set()
+        self.returned = []  # handlers given back by workers
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.stopped = threading.Event()
+        self.stopped.set()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    # ---------- selector loop (one thread) ----------
+    def serve_forever(self, poll_interval=0.5):
+        self.stopped.clear()
+        self.stopping = False
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self._wake_r, selectors.EVENT_READ)
+        last_sweep = time.monotonic()
+        try:
+            while not self.stopping:
+                for key, _ in self.selector.select(poll_interval):
+                    if key.fileobj is self.socket:
+                        self._accept()
+                    elif key.fileobj is self._wake_r:
+                        self._drain_wake()
+                    else:
+                        self._dispatch(key.data)
+                self._take_returned()
+                now = time.monotonic()
+                if now - last_sweep >= 1.0:
+                    self._close_idle(now - self.IDLE_TIMEOUT)
+                    last_sweep = now
+        finally:
+            with self.lock:
+                self.stopping = True
+                returned, self.returned = self.returned, []
+            for conn in list(self.idle) + returned:
+                self._close(conn)
+            self.selector.unregister(self.socket)
+            self.selector.unregister(self._wake_r)
+            self.stopped.set()
+
+    def shutdown(self):
+        self.stopping = True
+        self._wake()
+        self.stopped.wait()
+
+    def _accept(self):
+        # take the whole backlog: a burst of clients is one readable event
+        while True:
+            try:
+                request, client_address = self.get_request()
+            except OSError:  # BlockingIOError: backlog empty
+                return
+            self._add_connection(request, client_address)
+
+    def _add_connection(self, request, client_address):
+        if len(self.open) >= self.MAX_CONNECTIONS and not self._close_longest_idle():
+            self.shutdown_request(request)
+            return
+        try:
+            conn = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self.open.add(conn)
+        self._park(conn, time.monotonic())
+
+    def _dispatch(self, conn):
+        # readable: the connection leaves the selector until its worker is done
+        if conn in self.idle:
+            del self.idle[conn]
+            self.selector.unregister(conn.connection)
+        self.pool.submit(self._serve, conn)
+
+    def _take_returned(self):
+        with self.lock:
+            returned, self.returned = self.returned, []
+        now = time.monotonic()
+        for conn in returned:
+            if conn.close_connection:
+                self._close(conn)
+            else:
+                self._park(conn, now)
+
+    def _park(self, conn, now):
+        # wait in the selector (not on a worker) for the next request
+        self.idle[conn] = now
+        self.selector.register(conn.connection, selectors.EVENT_READ, conn)
+
+    def _close_idle(self, before):
+        while self.idle:
+            conn, since = next(iter(self.idle.items()))
+            if since > before:
+                break
+            self._close(conn)
+
+    def _close_longest_idle(self):
+        if not self.idle:
+            return False
+        self._close(next(iter(self.idle)))
+        return True
+
+    def _close(self, conn):
+        if conn in self.idle:
+            del self.idle[conn]
+            self.selector.unregister(conn.connection)
+        self.open.discard(conn)
+        try:
+            conn.finish()
+        except OSError:
+            pass
+        self.shutdown_request(conn.request)
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"x")
+        except (BlockingIOError, OSError):
+            pass  # already pending, or closing
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    # ---------- pool workers ----------
+    def _serve(self, conn):
+        try:
+            conn.handle_one_request()
+            while not conn.close_connection and conn.has_buffered_request():
+                conn.handle_one_request()
+        except Exception:
+            self.handle_error(conn.request, conn.client_address)
+            conn.close_connection = True
+        with self.lock:
+            if not self.stopping:
+                # one wake per batch: the loop takes every handler returned so far
+                wake = not self.returned
+                self.returned.append(conn)
+                conn = None
+        if conn is None:
+            if wake:
+                self._wake()
+        else:
+            conn.close_connection = True
+            try:
+                conn.finish()
+            except OSError:
+                pass
+            self.shutdown_request(conn.request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.shutdown(wait=False)
+        self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+
+# ---------- Load test ----------
+def bench(url, queries, n, concurrency):
+    u = urlsplit(url)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_worker = max(1, n // concurrency)
+
+    def worker(k):
+        con = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=30)  # one keep-alive connection
+        mine = []
+        bad = 0
+        for i in range(per_worker):
+            q = queries[(k + i) % len(queries)]
+            t0 = time.perf_counter()
+            try:
+                con.request("GET", "/lookup?" + urlencode({"q": q}))
+                resp = con.getresponse()
+                resp.read()
+            except (OSError, http.client.HTTPException):
+                # refused, reset or timed out: an error, and the next request reconnects
+                bad += 1
+                con.close()
+                continue
+            mine.append(time.perf_counter() - t0)
+            if resp.status != 200:
+                bad += 1
+        con.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += bad
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    latencies.sort()
+    print("requests   %d (errors %d), concurrency %d" % (len(latencies), errors[0], concurrency))
+    if not latencies:
+        print("no request completed (is the service running at %s?)" % url)
+        return 1
+    print("throughput %.0f req/s" % (len(latencies) / elapsed))
+    for pct in (50, 95, 99):
+        print("p%-9d %.3f ms" % (pct, 1000.0 * percentile(latencies, pct)))
+    print("max        %.3f ms" % (1000.0 * latencies[-1]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local JSON lookup service for the regulatory lists")
+    sub = parser.add_subparsers(dest="cmd")
+
+    p = sub.add_parser("serve", help="run the service (default)")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument("--verbose", action="store_true")
+
+    b = sub.add_parser("bench", help="load-test a running service")
+    b.add_argument("--url", default="http://127.0.0.1:8765")
+    b.add_argument("-n", type=int, default=2000, help="total requests")
+    b.add_argument("-c", type=int, default=8, help="concurrent keep-alive connections")
+    b.add_argument("queries", nargs="*", default=["benzoic", "65-85-0", "cas:50-00-0", "acid conc>1"])
+
+    args = parser.parse_args(argv)
+    if args.cmd == "bench":
+        return bench(args.url, args.queries, args.n, args.c)
+
+    host = getattr(args, "host", "127.0.0.1")
+    port = getattr(args, "port", 8765)
+    workers = getattr(args, "workers", 8)
+    index = LookupIndex(os.path.dirname(os.path.abspath(__file__)))
+    server = LookupServer((host, port), index, workers, getattr(args, "verbose", False))
+    print("serving %d rows on http://%s:%d (%d workers)" % (index.n, host, port, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
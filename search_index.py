@@ -0,0 +1,702 @@
+import bisect
+import csv
+import re
+
+# Column names shared by app.py and streamlit_app.py
+COL_ORDER = "ลำดับ"
+COL_CHEM = "Chemical Name/ Other Name"
+COL_COMMON = "Name of Common Ingredients Glossary"
+COL_CAS = "CAS Number"
+COL_USECASE = "กรณีที่ใช้"
+COL_MAXC = "ความเข้มข้นสูงสุดในเครื่องสำอางพร้อมใช้ (%w/w)"
+COL_COND = "เงื่อนไข"
+
+_NUM_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(mg/kg|ppm)?", re.IGNORECASE)
+_DIGITS_RE = re.compile(r"(\d+)")
+
+
+def read_csv_as_dicts(path):
+    for enc in ("utf-8-sig", "utf-8", "cp874"):
+        try:
+            with open(path, "r", encoding=enc, newline="") as f:
+                reader = csv.DictReader(f)
+                rows = list(reader)
+                headers = reader.fieldnames or []
+            return headers, rows
+        except UnicodeDecodeError:
+            continue
+    raise RuntimeError("อ่านไฟล์ไม่ได้: %s" % path)
+
+
+def text_of(v):
+    # CSV rows give str, pandas rows give NaN for empty cells
+    if v is None:
+        return ""
+    if isinstance(v, float) and v != v:
+        return ""
+    return str(v).strip()
+
+
+def natural_key(v):
+    # "1" < "1a" < "1b" < "2" < "10"
+    s = text_of(v).casefold()
+    if not s:
+        return None
+    parts = []
+    for i, p in enumerate(_DIGITS_RE.split(s)):
+        if i % 2:
+            parts.append((0, int(p), ""))
+        elif p:
+            parts.append((1, 0, p))
+    return tuple(parts)
+
+
+def parse_concentration(v):
+    # "2.5%\nคํานวณในรูปกรด" -> 2.5, "100 mg/kg" -> 0.01, "-" -> None
+    m = _NUM_RE.search(text_of(v))
+    if not m:
+        return None
+    x = float(m.group(1).replace(",", "."))
+    if m.group(2):
+        x /= 10000.0
+    return x
+
+
+def text_key(v):
+    return normalize_text(v) or None
+
+
+SORT_KEY_FUNCS = {
+    COL_ORDER: natural_key,
+    COL_MAXC: parse_concentration,
+}
+
+
+def sort_key_func(col):
+    return SORT_KEY_FUNCS.get(col, text_key)
+
+
+# columns the stores can sort by (the table columns of app.py)
+SORT_COLUMNS = [COL_ORDER, COL_CHEM, COL_COMMON, COL_CAS, COL_USECASE, COL_MAXC, COL_COND]
+
+
+class SortIndex(object):
+    """Sort keys and permutations over a fixed list of rows.
+
+    Keys are computed once per column; each (column, direction) permutation
+    is cached, so sorting a result set is a rank lookup instead of a sort
+    over the row dicts. Empty values always go last.
+    """
+
+    def __init__(self, rows, columns):
+        self.n = len(rows)
+        self.keys = {}
+        for c in columns:
+            f = sort_key_func(c)
+            self.keys[c] = [f(r.get(c)) for r in rows]
+        self._perm = {}
+        self._rank = {}
+
+    def permutation(self, col, reverse=False):
+        cache_key = (col, reverse)
+        perm = self._perm.get(cache_key)
+        if perm is None:
+            keys = self.keys[col]
+            present = [i for i in range(self.n) if keys[i] is not None]
+            # stable: ties keep file order in both directions
+            present.sort(key=keys.__getitem__, reverse=reverse)
+            perm = present + [i for i in range(self.n) if keys[i] is None]
+            self._perm[cache_key] = perm
+        return perm
+
+    def rank(self, col, reverse=False):
+        cache_key = (col, reverse)
+        rank = self._rank.get(cache_key)
+        if rank is None:
+            rank = [0] * self.n
+            for r, i in enumerate(self.permutation(col, reverse)):
+                rank[i] = r
+            self._rank[cache_key] = rank
+        return rank
+
+    def sort(self, positions, col, reverse=False):
+        if col not in self.keys:
+            return list(positions)
+        if len(positions) * 4 >= self.n:
+            # large result: gather from the cached permutation
+            hit = bytearray(self.n)
+            for p in positions:
+                hit[p] = 1
+            return [p for p in self.permutation(col, reverse) if hit[p]]
+        return sorted(positions, key=self.rank(col, reverse).__getitem__)
+
+
+# ---------- Query language ----------
+#
+#   benzoic               Common หรือ CAS มีคำนี้ (เหมือนเดิม)
+#   "benzoic acid"        วลี
+#   cas:65-85-0           เฉพาะฟิลด์: cas common chem cond use order source
+#   common:"salicylic acid"
+#   conc>1 conc<=0.5 conc:2.5
+#   a b / a AND b, a OR b, NOT a / -a, ( ... )
+
+SOURCE_FIELD = "_source"
+ALSO_IN_FIELD = "_also_in"
+
+QUERY_FIELDS = {
+    "cas": COL_CAS,
+    "common": COL_COMMON,
+    "chem": COL_CHEM,
+    "cond": COL_COND,
+    "use": COL_USECASE,
+    "order": COL_ORDER,
+    "source": SOURCE_FIELD,
+}
+
+DEFAULT_QUERY_FIELDS = (COL_COMMON, COL_CAS)
+
+_CMP_RE = re.compile(r"(?:conc|maxc)\s*:?\s*(<=|>=|<|>|=)?\s*(\d+(?:[.,]\d+)?)%?$", re.IGNORECASE)
+_FIELD_RE = re.compile(r"([A-Za-z]+):(.*)$", re.DOTALL)
+_KEYWORDS = ("AND", "OR", "NOT")
+
+
+def normalize_text(v):
+    return " ".join(text_of(v).split()).casefold()
+
+
+def _literal_paren_end(s, i):
+    # "(hcl)" at a token start is text, not a group: its ")" comes before any space
+    depth = 0
+    for j in range(i, len(s)):
+        c = s[j]
+        if c.isspace():
+            return -1
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return j
+    return -1
+
+
+def tokenize_query(s):
+    # "-" is NOT and "(" / ")" group only at word boundaries, so names like
+    # "N,N-bis(2-Hydroxyethyl)-p-phenylenediamine" stay literal.
+    tokens = []
+    groups = 0
+    i, n = 0, len(s)
+    while i < n:
+        c = s[i]
+        if c.isspace():
+            i += 1
+            continue
+        at_boundary = i == 0 or s[i - 1].isspace() or s[i - 1] == "("
+        if c == "(" and _literal_paren_end(s, i) < 0:
+            tokens.append(("(",))
+            groups += 1
+            i += 1
+            continue
+        if c == ")" and groups:
+            tokens.append((")",))
+            groups -= 1
+            i += 1
+            continue
+        if c == "-" and at_boundary and i + 1 < n and not s[i + 1].isspace() and not s[i + 1].isdigit():
+            tokens.append(("NOT",))
+            i += 1
+            continue
+        if c == '"':
+            j = s.find('"', i + 1)
+            j = n if j < 0 else j
+            tokens.append(("term", None, s[i + 1:j]))
+            i = j + 1
+            continue
+
+        # a word runs to whitespace, a quote, or a ")" that closes an open group
+        j = i
+        depth = 0
+        while j < n and not s[j].isspace() and s[j] != '"':
+            if s[j] == "(":
+                depth += 1
+            elif s[j] == ")":
+                if depth:
+                    depth -= 1
+                elif groups:
+                    break
+            j += 1
+        word = s[i:j]
+        i = j
+
+        if word in _KEYWORDS:
+            tokens.append((word,))
+            continue
+        m = _CMP_RE.match(word)
+        if m:
+            tokens.append(("cmp", m.group(1) or "=", float(m.group(2).replace(",", "."))))
+            continue
+        m = _FIELD_RE.match(word)
+        if m and m.group(1).lower() in QUERY_FIELDS:
+            field = QUERY_FIELDS[m.group(1).lower()]
+            rest = m.group(2)
+            if not rest and i < n and s[i] == '"':
+                j = s.find('"', i + 1)
+                j = n if j < 0 else j
+                rest = s[i + 1:j]
+                i = j + 1
+            if rest:
+                tokens.append(("term", field, rest))
+            # "cas:" ที่ยังพิมพ์ไม่จบ: ข้าม
+            continue
+        tokens.append(("term", None, word))
+    return tokens
+
+
+class _QueryParser(object):
+    # Lenient on purpose: the query is re-run on every keystroke, so half-typed
+    # input (open quotes/parens, trailing operators) must still give a plan.
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def parse(self):
+        nodes = []
+        while self.pos < len(self.tokens):
+            node = self.parse_or()
+            if node is not None:
+                nodes.append(node)
+            elif self.peek() == ")":
+                self.pos += 1  # stray ")"
+        return _combine("and", nodes)
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == "OR":
+            self.pos += 1
+            nodes.append(self.parse_and())
+        return _combine("or", [x for x in nodes if x is not None])
+
+    def parse_and(self):
+        nodes = []
+        while True:
+            kind = self.peek()
+            if kind is None or kind in ("OR", ")"):
+                break
+            if kind == "AND":
+                self.pos += 1
+                continue
+            node = self.parse_unary()
+            if node is not None:
+                nodes.append(node)
+        return _combine("and", nodes)
+
+    def parse_unary(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        if tok[0] == "NOT":
+            if self.peek() in (None, "OR", ")"):
+                return None
+            child = self.parse_unary()
+            return None if child is None else ("not", child)
+        if tok[0] == "(":
+            node = self.parse_or()
+            if self.peek() == ")":
+                self.pos += 1
+            return node
+        if tok[0] == "term":
+            text = normalize_text(tok[2])
+            return ("term", tok[1], text) if text else None
+        if tok[0] == "cmp":
+            return tok
+        return None
+
+
+def _combine(kind, nodes):
+    if not nodes:
+        return None
+    if len(nodes) == 1:
+        return nodes[0]
+    return (kind, nodes)
+
+
+def parse_query(s):
+    return _QueryParser(tokenize_query(s or "")).parse()
+
+
+def _grams(s):
+    return set(s[k:k + 3] for k in range(len(s) - 2))
+
+
+class FieldIndex(object):
+    """Substring index over one column.
+
+    Rows are grouped by distinct normalized value and a trigram index maps
+    to those values, so a lookup only verifies the few values that share
+    every trigram of the query.
+    """
+
+    def __init__(self, values):
+        self.norm = [normalize_text(v) for v in values]
+        self.values = []
+        self.postings = []
+        self.grams = {}
+        self.gram_rows = {}
+        self.filled = 0
+        value_ids = {}
+        for i, s in enumerate(self.norm):
+            if not s:
+                continue
+            self.filled += 1
+            vid = value_ids.get(s)
+            if vid is None:
+                vid = value_ids[s] = len(self.values)
+                self.values.append(s)
+                self.postings.append([])
+                for g in _grams(s):
+                    self.grams.setdefault(g, set()).add(vid)
+            self.postings[vid].append(i)
+        for g, vids in self.grams.items():
+            self.gram_rows[g] = sum(len(self.postings[v]) for v in vids)
+
+    def estimate(self, q):
+        grams = _grams(q)
+        if not grams:
+            return self.filled
+        return min(self.gram_rows.get(g, 0) for g in grams)
+
+    def lookup(self, q):
+        grams = _grams(q)
+        if grams:
+            sets = sorted((self.grams.get(g, ()) for g in grams), key=len)
+            candidates = set(sets[0])
+            for s in sets[1:]:
+                if not candidates:
+                    break
+                candidates &= s
+        else:
+            candidates = range(len(self.values))
+        out = set()
+        for vid in candidates:
+            if q in self.values[vid]:
+                out.update(self.postings[vid])
+        return out
+
+    def match(self, i, q):
+        return q in self.norm[i]
+
+
+class QueryIndex(object):
+    """Per-field indexes over a fixed list of rows, queried with parse_query syntax.
+
+    search() returns matching row positions in file order.
+    """
+
+    # AND: once the running result is this small, test remaining terms row by row
+    ROW_CHECK_LIMIT = 64
+    CACHE_SIZE = 256
+
+    def __init__(self, rows, sources=None):
+        self.n = len(rows)
+        self.fields = {}
+        for col in set(QUERY_FIELDS.values()):
+            if col == SOURCE_FIELD:
+                values = sources if sources is not None else [r.get(SOURCE_FIELD) for r in rows]
+            else:
+                values = [r.get(col) for r in rows]
+            self.fields[col] = FieldIndex(values)
+        self.conc = [parse_concentration(r.get(COL_MAXC)) for r in rows]
+        pairs = sorted((x, i) for i, x in enumerate(self.conc) if x is not None)
+        self.conc_values = [x for x, _ in pairs]
+        self.conc_ids = [i for _, i in pairs]
+        self._cache = {}
+
+    def search(self, query):
+        key = (query or "").strip()
+        hit = self._cache.get(key)
+        if hit is None:
+            plan = parse_query(key)
+            if plan is None:
+                hit = list(range(self.n))
+            else:
+                hit = sorted(self._eval(plan))
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = hit
+        return hit
+
+    # ---------- plan ----------
+    def _term_fields(self, node):
+        if node[1] is None:
+            return [self.fields[c] for c in DEFAULT_QUERY_FIELDS]
+        return [self.fields[node[1]]]
+
+    def _cmp_range(self, op, x):
+        vals = self.conc_values
+        if op == "<":
+            return 0, bisect.bisect_left(vals, x)
+        if op == "<=":
+            return 0, bisect.bisect_right(vals, x)
+        if op == ">":
+            return bisect.bisect_right(vals, x), len(vals)
+        if op == ">=":
+            return bisect.bisect_left(vals, x), len(vals)
+        return bisect.bisect_left(vals, x), bisect.bisect_right(vals, x)
+
+    def _estimate(self, node):
+        kind = node[0]
+        if kind == "term":
+            return min(self.n, sum(f.estimate(node[2]) for f in self._term_fields(node)))
+        if kind == "cmp":
+            lo, hi = self._cmp_range(node[1], node[2])
+            return hi - lo
+        if kind == "and":
+            return min([self._estimate(c) for c in node[1] if c[0] != "not"] or [self.n])
+        if kind == "or":
+            return min(self.n, sum(self._estimate(c) for c in node[1]))
+        return self.n
+
+    def _match(self, node, i):
+        kind = node[0]
+        if kind == "term":
+            return any(f.match(i, node[2]) for f in self._term_fields(node))
+        if kind == "cmp":
+            x = self.conc[i]
+            if x is None:
+                return False
+            op, y = node[1], node[2]
+            if op == "<":
+                return x < y
+            if op == "<=":
+                return x <= y
+            if op == ">":
+                return x > y
+            if op == ">=":
+                return x >= y
+            return x == y
+        if kind == "not":
+            return not self._match(node[1], i)
+        if kind == "and":
+            return all(self._match(c, i) for c in node[1])
+        return any(self._match(c, i) for c in node[1])
+
+    def _eval(self, node):
+        kind = node[0]
+        if kind == "term":
+            out = set()
+            for f in self._term_fields(node):
+                out |= f.lookup(node[2])
+            return out
+        if kind == "cmp":
+            lo, hi = self._cmp_range(node[1], node[2])
+            return set(self.conc_ids[lo:hi])
+        if kind == "not":
+            return set(range(self.n)) - self._eval(node[1])
+        if kind == "or":
+            out = set()
+            for c in node[1]:
+                out |= self._eval(c)
+            return out
+        return self._eval_and(node[1])
+
+    def _eval_and(self, children):
+        # most selective positive term first, NOT terms last (as a filter)
+        positives = sorted((c for c in children if c[0] != "not"), key=self._estimate)
+        negatives = [c for c in children if c[0] == "not"]
+        out = None
+        for c in positives:
+            if out is not None and len(out) <= self.ROW_CHECK_LIMIT:
+                out = set(i for i in out if self._match(c, i))
+            else:
+                s = self._eval(c)
+                out = s if out is None else out & s
+            if not out:
+                return set()
+        if out is None:
+            out = set(range(self.n))
+        for c in negatives:
+            if len(out) <= self.ROW_CHECK_LIMIT:
+                out = set(i for i in out if self._match(c, i))
+            else:
+                out -= self._eval(c[1])
+            if not out:
+                break
+        return out
+
+
+# ---------- Ingredient groups ----------
+
+_CAS_RE = re.compile(r"\d{2,7}-\d{2}-\d")
+
+
+def canonical_cas(v):
+    # "10043-35-3/\n11113-50-1" -> "10043-35-3/11113-50-1" (sorted, deduplicated)
+    found = sorted(set(_CAS_RE.findall(text_of(v))))
+    if found:
+        return "/".join(found)
+    s = normalize_text(v)
+    return "" if s == "-" else s
+
+
+def canonical_name(v):
+    s = normalize_text(v)
+    return "" if s == "-" else s
+
+
+def group_key(row, source=None):
+    cas = canonical_cas(row.get(COL_CAS))
+    common = canonical_name(row.get(COL_COMMON))
+    if not cas and not common:
+        return None
+    return source, cas, common
+
+
+class GroupIndex(object):
+    """Rows of the same substance (canonical CAS + Common name, per source).
+
+    Rows without CAS and Common name stay on their own.
+    """
+
+    def __init__(self, rows, sources=None):
+        self.group_of = []
+        self.members = []
+        ids = {}
+        for i, r in enumerate(rows):
+            src = sources[i] if sources is not None else r.get(SOURCE_FIELD)
+            key = group_key(r, src)
+            g = ids.get(key) if key is not None else None
+            if g is None:
+                g = len(self.members)
+                self.members.append([])
+                if key is not None:
+                    ids[key] = g
+            self.group_of.append(g)
+            self.members[g].append(i)
+
+    def group(self, positions):
+        # [(group, [positions in that group])], groups in order of their first hit
+        out = []
+        slot = {}
+        for p in positions:
+            g = self.group_of[p]
+            k = slot.get(g)
+            if k is None:
+                slot[g] = len(out)
+                out.append((g, [p]))
+            else:
+                out[k][1].append(p)
+        return out
+
+
+# ---------- Cross-list references ----------
+
+
+def link_keys(row):
+    # each CAS number and the Common name link a row to other lists
+    keys = [("cas", c) for c in _CAS_RE.findall(text_of(row.get(COL_CAS)))]
+    name = canonical_name(row.get(COL_COMMON))
+    if name:
+        keys.append(("name", name))
+    return keys
+
+
+class CrossIndex(object):
+    """Which other source lists regulate the same substance as each row.
+
+    Rows are linked by any shared CAS number or Common name. also_in[i] is a
+    tuple of the other sources, in the order the sources were loaded.
+    """
+
+    def __init__(self, rows, sources=None):
+        if sources is None:
+            sources = [r.get(SOURCE_FIELD) for r in rows]
+        order = {}
+        for src in sources:
+            order.setdefault(src, len(order))
+
+        row_keys = [link_keys(r) for r in rows]
+        key_sources = {}
+        for keys, src in zip(row_keys, sources):
+            for k in keys:
+                key_sources.setdefault(k, set()).add(src)
+
+        self.also_in = []
+        for keys, src in zip(row_keys, sources):
+            found = set()
+            for k in keys:
+                found |= key_sources[k]
+            found.discard(src)
+            self.also_in.append(tuple(sorted(found, key=order.get)))
+
+
+# ---------- Store ----------
+
+
+class MemoryStore(object):
+    """Rows of several sources in memory, with every index built at load.
+
+    Row ids are positions in the concatenation of the sources, in load
+    order. sqlite_store.SqliteStore has the same interface and answers from
+    the database instead, so the apps use either one.
+    """
+
+    def __init__(self, datasets):
+        # datasets: [(source, headers, rows)]
+        self.sources = []
+        self.headers = {}
+        self.counts = {}
+        self.rows = []
+        self.ranges = {}
+        row_sources = []
+        for source, headers, rows in datasets:
+            self.sources.append(source)
+            self.headers[source] = list(headers)
+            self.counts[source] = len(rows)
+            self.ranges[source] = (len(self.rows), len(self.rows) + len(rows))
+            self.rows.extend(rows)
+            row_sources.extend([source] * len(rows))
+        self.n = len(self.rows)
+
+        self.query_index = QueryIndex(self.rows, row_sources)
+        self.sort_index = SortIndex(self.rows, SORT_COLUMNS)
+        self.group_index = GroupIndex(self.rows, row_sources)
+        self.also_in = CrossIndex(self.rows, row_sources).also_in
+        for r, src, also_in in zip(self.rows, row_sources, self.also_in):
+            r[SOURCE_FIELD] = src
+            r[ALSO_IN_FIELD] = also_in
+
+    def search(self, query):
+        # ids of all sources in file order
+        return self.query_index.search(query)
+
+    def select(self, query, sources=None, sort=None, desc=False, multi_only=False):
+        ids = self.query_index.search(query)
+        if sources is not None and set(sources) != set(self.sources):
+            ranges = [self.ranges[s] for s in sources if s in self.ranges]
+            ids = [p for p in ids if any(lo <= p < hi for lo, hi in ranges)]
+        if multi_only:
+            also_in = self.also_in
+            ids = [p for p in ids if also_in[p]]
+        if sort is not None:
+            ids = self.sort_index.sort(ids, sort, desc)
+        return ids
+
+    def count(self, query, sources=None, multi_only=False):
+        return len(self.select(query, sources, multi_only=multi_only))
+
+    def page(self, query, sources=None, sort=None, desc=False, multi_only=False, offset=0, limit=None):
+        ids = self.select(query, sources, sort, desc, multi_only)
+        return ids[offset:] if limit is None else ids[offset:offset + limit]
+
+    def groups(self, ids):
+        return self.group_index.group(ids)
+
+    def fetch(self, ids):
+        # row dicts with SOURCE_FIELD and ALSO_IN_FIELD set
+        rows = self.rows
+        return [rows[p] for p in ids]
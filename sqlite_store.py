@@ -0,0 +1,354 @@
+"""Optional SQLite storage for the regulatory lists.
+
+Set SEARCH_DB=<path> to make app.py / streamlit_app.py / lookup_service.py
+import the CSV files once into a local SQLite file and answer from it
+through SqliteStore, which has the same interface as
+search_index.MemoryStore. Everything the apps need per row is computed at
+import: normalized text (FTS5 trigram table), concentration, sort ranks,
+substance group and the other lists it is in. Queries return sorted pages
+of ids, and only the rows being shown are decoded. The file is rebuilt only
+when a CSV changes, and several processes can share it read-only.
+
+    python sqlite_store.py [db_path]    # import now (default: search.db)
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+
+from search_index import (
+    ALSO_IN_FIELD,
+    COL_CAS,
+    COL_CHEM,
+    COL_COMMON,
+    COL_COND,
+    COL_MAXC,
+    COL_ORDER,
+    COL_USECASE,
+    DEFAULT_QUERY_FIELDS,
+    SORT_COLUMNS,
+    SOURCE_FIELD,
+    CrossIndex,
+    GroupIndex,
+    SortIndex,
+    normalize_text,
+    parse_concentration,
+    parse_query,
+    read_csv_as_dicts,
+)
+
+DB_ENV = "SEARCH_DB"
+
+# bump when the tables change: older files are rebuilt
+SCHEMA_VERSION = 3
+
+# query field -> normalized column in rows / rows_fts
+FIELD_COLUMNS = {
+    COL_CAS: "cas",
+    COL_COMMON: "common",
+    COL_CHEM: "chem",
+    COL_COND: "cond",
+    COL_USECASE: "use_case",
+    COL_ORDER: "ord",
+    SOURCE_FIELD: "src",
+}
+
+# sort column -> dense rank column (NULL = empty value, sorted last)
+RANK_COLUMNS = dict((col, "rk_%d" % i) for i, col in enumerate(SORT_COLUMNS))
+
+_TEXT_COLUMNS = list(FIELD_COLUMNS.values())
+_ROW_COLUMNS = (
+    ["id", "source", "data", "conc", "grp", "also_in", "multi"]
+    + [RANK_COLUMNS[c] for c in SORT_COLUMNS]
+    + _TEXT_COLUMNS
+)
+
+_SCHEMA = """
+CREATE TABLE meta (
+    seq INTEGER PRIMARY KEY,
+    file TEXT, source TEXT, size INTEGER, mtime REAL, n INTEGER, headers TEXT
+);
+CREATE TABLE rows (
+    id INTEGER PRIMARY KEY,
+    source TEXT, data TEXT, conc REAL,
+    grp INTEGER, also_in TEXT, multi INTEGER,
+    %s,
+    %s
+);
+CREATE INDEX rows_source ON rows (source, id);
+CREATE INDEX rows_conc ON rows (conc);
+""" % (
+    ",\n    ".join("%s INTEGER" % RANK_COLUMNS[c] for c in SORT_COLUMNS),
+    ",\n    ".join("%s TEXT" % c for c in _TEXT_COLUMNS),
+)
+
+_FTS = "CREATE VIRTUAL TABLE rows_fts USING fts5(%s, content='rows', content_rowid='id', tokenize='trigram')" % (
+    ", ".join(_TEXT_COLUMNS)
+)
+
+
+def default_db_path(base_dir):
+    # SEARCH_DB relative to the app folder; None = in-memory backend
+    path = os.environ.get(DB_ENV, "").strip()
+    if not path:
+        return None
+    return os.path.join(base_dir, path)
+
+
+def _connect_ro(db_path):
+    return sqlite3.connect(Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+
+def _is_current(db_path, files):
+    if not os.path.exists(db_path):
+        return False
+    try:
+        con = _connect_ro(db_path)
+        try:
+            if con.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                return False
+            meta = con.execute("SELECT file, source, size, mtime FROM meta ORDER BY seq").fetchall()
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return False
+    want = []
+    for path, source in files:
+        if os.path.exists(path):
+            size, mtime = _file_stat(path)
+            want.append((os.path.abspath(path), source, size, mtime))
+    return [tuple(m) for m in meta] == want
+
+
+def dense_ranks(sort_index, col):
+    # equal keys share a rank, so ties keep file order (ORDER BY ..., id) both ways
+    keys = sort_index.keys[col]
+    ranks = [None] * sort_index.n
+    rank, prev = 0, None
+    for i in sort_index.permutation(col):
+        k = keys[i]
+        if k is None:
+            break
+        if prev is None or k != prev:
+            rank += 1
+            prev = k
+        ranks[i] = rank
+    return ranks
+
+
+def build_store(db_path, files):
+    # read every file first: groups and cross-list links span all sources
+    loaded = []
+    all_rows, row_sources = [], []
+    for seq, (path, source) in enumerate(files):
+        if not os.path.exists(path):
+            continue
+        headers, rows = read_csv_as_dicts(path)
+        size, mtime = _file_stat(path)
+        loaded.append((seq, os.path.abspath(path), source, size, mtime, len(rows), headers))
+        all_rows.extend(rows)
+        row_sources.extend([source] * len(rows))
+
+    groups = GroupIndex(all_rows, row_sources)
+    also_in = CrossIndex(all_rows, row_sources).also_in
+    sort_index = SortIndex(all_rows, SORT_COLUMNS)
+    ranks = [dense_ranks(sort_index, c) for c in SORT_COLUMNS]
+
+    # import into a temp file, then swap it in so readers never see a half-built db
+    tmp = "%s.%d.tmp" % (db_path, os.getpid())
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = sqlite3.connect(tmp)
+    try:
+        con.executescript(_SCHEMA)
+        con.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        try:
+            con.execute(_FTS)
+            has_fts = True
+        except sqlite3.OperationalError:
+            # SQLite without FTS5/trigram: substring search falls back to instr()
+            has_fts = False
+
+        for seq, path, source, size, mtime, n, headers in loaded:
+            con.execute(
+                "INSERT INTO meta VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (seq, path, source, size, mtime, n, json.dumps(headers, ensure_ascii=False)),
+            )
+
+        batch = []
+        for row_id, (r, source) in enumerate(zip(all_rows, row_sources)):
+            batch.append(
+                [
+                    row_id,
+                    source,
+                    json.dumps(r, ensure_ascii=False),
+                    parse_concentration(r.get(COL_MAXC)),
+                    groups.group_of[row_id],
+                    json.dumps(also_in[row_id], ensure_ascii=False),
+                    1 if also_in[row_id] else 0,
+                ]
+                + [rk[row_id] for rk in ranks]
+                + [normalize_text(source if col == SOURCE_FIELD else r.get(col)) for col in FIELD_COLUMNS]
+            )
+        con.executemany(
+            "INSERT INTO rows (%s) VALUES (%s)" % (", ".join(_ROW_COLUMNS), ", ".join("?" * len(_ROW_COLUMNS))),
+            batch,
+        )
+
+        if has_fts:
+            con.execute("INSERT INTO rows_fts(rows_fts) VALUES ('rebuild')")
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp, db_path)
+
+
+def ensure_store(db_path, files):
+    """Build db_path from files [(csv path, source label)] unless it is up to date."""
+    if not _is_current(db_path, files):
+        build_store(db_path, files)
+    return db_path
+
+
+class _Reader(object):
+    # one read-only connection per thread (Streamlit runs sessions in threads)
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def connect(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = _connect_ro(self.db_path)
+            self._local.con = con
+        return con
+
+
+class SqliteStore(object):
+    """search_index.MemoryStore over the SQLite store.
+
+    Filtering, sorting and paging run in SQL; fetch() decodes only the rows
+    asked for, so memory use does not grow with the size of the lists.
+    """
+
+    def __init__(self, db_path):
+        self.reader = _Reader(db_path)
+        con = self.reader.connect()
+        meta = con.execute("SELECT source, n, headers FROM meta ORDER BY seq").fetchall()
+        self.sources = [source for source, _, _ in meta]
+        self.counts = dict((source, n) for source, n, _ in meta)
+        self.headers = dict((source, json.loads(h)) for source, _, h in meta)
+        self.n = sum(self.counts.values())
+        self.has_fts = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'rows_fts'"
+        ).fetchone() is not None
+
+    def search(self, query):
+        # ids of all sources in file order
+        return self.select(query)
+
+    def select(self, query, sources=None, sort=None, desc=False, multi_only=False):
+        return self.page(query, sources, sort, desc, multi_only)
+
+    def count(self, query, sources=None, multi_only=False):
+        where, params = self._where(query, sources, multi_only)
+        return self.reader.connect().execute("SELECT count(*) FROM rows WHERE " + where, params).fetchone()[0]
+
+    def page(self, query, sources=None, sort=None, desc=False, multi_only=False, offset=0, limit=None):
+        where, params = self._where(query, sources, multi_only)
+        rk = RANK_COLUMNS.get(sort)
+        if rk is None:
+            order = "id"
+        else:
+            order = "%s IS NULL, %s%s, id" % (rk, rk, " DESC" if desc else "")
+        sql = "SELECT id FROM rows WHERE %s ORDER BY %s LIMIT ? OFFSET ?" % (where, order)
+        params.extend([-1 if limit is None else limit, offset])
+        return [i for (i,) in self.reader.connect().execute(sql, params)]
+
+    def groups(self, ids):
+        # [(group, [ids in that group])], groups in order of their first id
+        group_of = dict(self._by_id("id, grp", ids))
+        out = []
+        slot = {}
+        for p in ids:
+            g = group_of[p]
+            k = slot.get(g)
+            if k is None:
+                slot[g] = len(out)
+                out.append((g, [p]))
+            else:
+                out[k][1].append(p)
+        return out
+
+    def fetch(self, ids):
+        # row dicts with SOURCE_FIELD and ALSO_IN_FIELD set
+        rows = {}
+        for i, source, data, also_in in self._by_id("id, source, data, also_in", ids):
+            r = json.loads(data)
+            r[SOURCE_FIELD] = source
+            r[ALSO_IN_FIELD] = tuple(json.loads(also_in))
+            rows[i] = r
+        return [rows[p] for p in ids]
+
+    def _by_id(self, columns, ids):
+        if not ids:
+            return []
+        sql = "SELECT %s FROM rows WHERE id IN (SELECT value FROM json_each(?))" % columns
+        return self.reader.connect().execute(sql, (json.dumps(list(ids)),)).fetchall()
+
+    def _where(self, query, sources, multi_only):
+        params = []
+        clauses = []
+        if sources is not None and set(sources) != set(self.sources):
+            sources = list(sources)
+            clauses.append("source IN (%s)" % ", ".join("?" * len(sources)))
+            params.extend(sources)
+        if multi_only:
+            clauses.append("multi = 1")
+        plan = parse_query((query or "").strip())
+        if plan is not None:
+            clauses.append(self._sql(plan, params))
+        return " AND ".join(clauses) or "1", params
+
+    def _sql(self, node, params):
+        kind = node[0]
+        if kind == "term":
+            fields = DEFAULT_QUERY_FIELDS if node[1] is None else (node[1],)
+            cols = [FIELD_COLUMNS[f] for f in fields]
+            text = node[2]
+            if self.has_fts and len(text) >= 3:
+                # trigram phrase match == substring match on the normalized text
+                params.append('{%s} : "%s"' % (" ".join(cols), text.replace('"', '""')))
+                return "id IN (SELECT rowid FROM rows_fts WHERE rows_fts MATCH ?)"
+            params.extend([text] * len(cols))
+            return "(%s)" % " OR ".join("instr(%s, ?) > 0" % c for c in cols)
+        if kind == "cmp":
+            # no concentration = no match, also under NOT; plain comparison so rows_conc applies
+            params.append(node[2])
+            return "(conc IS NOT NULL AND conc %s ?)" % node[1]
+        if kind == "not":
+            return "NOT (%s)" % self._sql(node[1], params)
+        joiner = " AND " if kind == "and" else " OR "
+        return "(%s)" % joiner.join(self._sql(c, params) for c in node[1])
+
+
+if __name__ == "__main__":
+    base = os.path.dirname(os.path.abspath(__file__))
+    db = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base, "search.db")
+    build_store(
+        db,
+        [
+            (os.path.join(base, "preservatives.csv"), "วัตถุกันเสีย"),
+            (os.path.join(base, "allowed.csv"), "วัตถุอาจใช้เป็นส่วนผสม"),
+        ],
+    )
+    print("เขียน %s แล้ว" % db)
@@ -2,6 +2,9 @@ import pandas as pd
 import streamlit as st
 from pathlib import Path
 
+from search_index import ALSO_IN_FIELD, SOURCE_FIELD, MemoryStore
+from sqlite_store import SqliteStore, default_db_path, ensure_store
+
 APP_TITLE = "Specified Allowable Concentration Search System for Cosmetic Preservatives and Ingredients"
 
 # ---- Column names (หลัก ๆ) ----
@@ -25,6 +28,29 @@ AREA_COL_CANDIDATES = [
     "บริเวณ/ส่วนของร่างกายที่ใช้",
 ]
 
+# ---- แหล่งข้อมูลของแต่ละไฟล์ ----
+SOURCE_LABELS = {
+    "preservatives.csv": "วัตถุกันเสีย",
+    "allowed.csv": "วัตถุอาจใช้เป็นส่วนผสม",
+}
+
+QUERY_HELP = (
+    "พิมพ์ Common หรือ CAS ได้ตามปกติ หรือใช้รูปแบบขั้นสูง: "
+    "cas:65-85-0, common:\"benzoic acid\", chem:, cond:, use:, order:, source:, "
+    "conc>1 / conc<=0.5, AND / OR / NOT (หรือ -คำ) และวงเล็บ ( )"
+)
+
+# ---- ตัวเลือกการเรียงลำดับ (None = ตามลำดับในไฟล์) ----
+SORT_OPTIONS = {
+    "ตามลำดับในไฟล์": None,
+    "ลำดับ": COL_ORDER,
+    "Common": COL_COMMON,
+    "CAS": COL_CAS,
+    "Chemical Name": COL_CHEM,
+    "ความเข้มข้นสูงสุด": COL_MAXC,
+    "กรณีที่ใช้": COL_USECASE,
+}
+
 # -------------------- Helpers --------------------
 def clean_val(v):
     if v is None:
@@ -39,12 +65,9 @@ def clean_val(v):
         return "-"
     return s
 
-def norm_series(s: pd.Series) -> pd.Series:
-    return s.astype(str).str.lower().str.strip()
-
-def pick_col(df: pd.DataFrame, candidates: list[str]) -> str | None:
+def pick_col(columns: list[str], candidates: list[str]) -> str | None:
     for c in candidates:
-        if c in df.columns:
+        if c in columns:
             return c
     return None
 
@@ -61,6 +84,71 @@ def load_csv(path: str) -> pd.DataFrame:
     except Exception:
         raise last_err
 
+@st.cache_resource
+def load_store() -> tuple[MemoryStore | SqliteStore, str | None]:
+    # แถว + index ของทุกบัญชีที่โหลดได้ สร้างครั้งเดียว ใช้ร่วมกันทุก session
+    # SEARCH_DB=... : ใช้ SQLite ร่วมกันทุก worker (import CSV ครั้งเดียว)
+    # ถ้าใช้ฐานข้อมูลไม่ได้ อ่าน CSV แทนแบบ app.py และคืนข้อความ error (cache ไว้ ไม่ import ซ้ำทุก rerun)
+    db_error = None
+    db_path = default_db_path(".")
+    if db_path:
+        try:
+            ensure_store(db_path, list(SOURCE_LABELS.items()))
+            return SqliteStore(db_path), None
+        except Exception as e:
+            db_error = f"ใช้ฐานข้อมูล {db_path} ไม่ได้ ({e}) — อ่านจากไฟล์ CSV แทน"
+    datasets = []
+    for path, source in SOURCE_LABELS.items():
+        try:
+            df = load_csv(path)
+        except Exception:
+            continue
+        datasets.append((source, list(df.columns), df.to_dict("records")))
+    return MemoryStore(datasets), db_error
+
+def build_card(row: dict, source: str, area_col: str | None) -> dict:
+    common = clean_val(row.get(COL_COMMON, "-"))
+    cas = clean_val(row.get(COL_CAS, "-"))
+    order = clean_val(row.get(COL_ORDER, "-"))
+
+    # Subtitle: "วัตถุกันเสีย • ลำดับ: 1" (ตัด CAS ออกไป)
+    subtitle_parts = [source]
+    if order != "-":
+        subtitle_parts.append(f"ลำดับ: {order}")
+
+    # เฉพาะ allowed เท่านั้น: บริเวณที่ใช้
+    area_val = "-"
+    if source == "วัตถุอาจใช้เป็นส่วนผสม" and area_col is not None:
+        area_val = clean_val(row.get(area_col, "-"))
+
+    return {
+        "title_html": f'<div class="card-title">{build_title(common, cas)}</div>',
+        "subtitle_html": f'<div class="card-subtitle">{" • ".join(subtitle_parts)}</div>',
+        "source": source,
+        "cas": cas,
+        "maxc": clean_val(row.get(COL_MAXC, "-")),
+        "usecase": clean_val(row.get(COL_USECASE, "-")),
+        "chem": clean_val(row.get(COL_CHEM, "-")),
+        "area": area_val,
+        "cond": clean_val(row.get(COL_COND, "-")),
+        "also_in": row.get(ALSO_IN_FIELD, ()),
+    }
+
+@st.cache_resource
+def card_cache() -> dict[int, dict]:
+    # การ์ดที่เคยแสดงแล้ว ตาม row id (ข้อมูลไม่เปลี่ยนระหว่างรัน) ใช้ร่วมกันทุก session
+    return {}
+
+def load_cards(store: MemoryStore | SqliteStore, ids: list[int]) -> list[dict]:
+    # อ่านจาก store เฉพาะแถวที่ยังไม่เคยแสดง
+    cache = card_cache()
+    missing = [p for p in ids if p not in cache]
+    if missing:
+        for p, row in zip(missing, store.fetch(missing)):
+            source = row[SOURCE_FIELD]
+            cache[p] = build_card(row, source, pick_col(store.headers[source], AREA_COL_CANDIDATES))
+    return [cache[p] for p in ids]
+
 def find_logo_path() -> str | None:
     candidates = [
         "logo.png", "logo.jpg", "logo.jpeg", "logo.webp",
@@ -236,142 +324,147 @@ st.markdown("</div>", unsafe_allow_html=True)
 st.divider()
 
 # -------------------- Load data --------------------
-df_pres = None
-df_allow = None
+store, db_error = load_store()
+if db_error:
+    st.warning(db_error)
 
-try:
-    df_pres = load_csv("preservatives.csv")
-except Exception:
-    pass
+has_pres = SOURCE_LABELS["preservatives.csv"] in store.sources
+has_allow = SOURCE_LABELS["allowed.csv"] in store.sources
 
-try:
-    df_allow = load_csv("allowed.csv")
-except Exception:
-    pass
-
-if df_pres is None and df_allow is None:
+if not has_pres and not has_allow:
     st.error("ไม่พบไฟล์ preservatives.csv และ allowed.csv ในโฟลเดอร์เดียวกับไฟล์ streamlit_app.py")
     st.stop()
 
-if df_pres is not None:
-    df_pres["แหล่งข้อมูล"] = "วัตถุกันเสีย"
-if df_allow is not None:
-    df_allow["แหล่งข้อมูล"] = "วัตถุอาจใช้เป็นส่วนผสม"
-
 # -------------------- Controls --------------------
 left, right = st.columns([1.35, 3.0])
 with left:
     options = []
-    if df_pres is not None and df_allow is not None:
+    if has_pres and has_allow:
         options = ["ข้อมูลทั้งหมด", "วัตถุกันเสีย", "วัตถุอาจใช้เป็นส่วนผสม"]
-    elif df_pres is not None:
+    elif has_pres:
         options = ["วัตถุกันเสีย"]
     else:
         options = ["วัตถุอาจใช้เป็นส่วนผสม"]
     dataset = st.selectbox("ชุดข้อมูล", options)
 
 with right:
-    q = st.text_input("ค้นหา (Common หรือ CAS)", placeholder="เช่น Benzoic acid หรือ 65-85-0")
-
-# dataset selection
-if dataset == "วัตถุกันเสีย":
-    df = df_pres.copy()
-elif dataset == "วัตถุอาจใช้เป็นส่วนผสม":
-    df = df_allow.copy()
+    q = st.text_input("ค้นหา (Common หรือ CAS)", placeholder="เช่น Benzoic acid หรือ 65-85-0", help=QUERY_HELP)
+
+# dataset selection (None = ทุกบัญชี)
+sources = None if dataset == "ข้อมูลทั้งหมด" else [dataset]
+
+# -------------------- Sort --------------------
+s1, s2, s3 = st.columns([1.35, 1.8, 1.2])
+with s1:
+    sort_label = st.selectbox("เรียงตาม", list(SORT_OPTIONS))
+with s2:
+    sort_desc = st.radio("ทิศทาง", ["น้อย → มาก", "มาก → น้อย"], horizontal=True) == "มาก → น้อย"
+with s3:
+    grouped = st.toggle("จัดกลุ่มตามสาร", help="รวมรายการของสารเดียวกัน (CAS + Common) เป็นการ์ดเดียว")
+    multi_only = st.toggle("เฉพาะสารที่อยู่หลายบัญชี", help="สารที่มี CAS หรือ Common ตรงกับรายการในบัญชีอื่น")
+
+sort_col = SORT_OPTIONS[sort_label]
+
+# -------------------- Filter realtime (query language, ดู QUERY_HELP) --------------------
+# หน่วยที่แบ่งหน้า: แถว หรือ (กลุ่ม, แถวในกลุ่ม); แบบแถวดึงเฉพาะหน้าที่แสดงจาก store
+if grouped:
+    hit_pos = store.select(q, sources, sort_col, sort_desc, multi_only)
+    units = store.groups(hit_pos)
+    total = len(units)
+    st.write(f"พบ **{len(hit_pos):,}** รายการ ใน **{total:,}** สาร")
 else:
-    df = pd.concat([df_pres, df_allow], ignore_index=True)
-
-# -------------------- Filter realtime (Common + CAS เท่านั้น) --------------------
-df_f = df.copy()
-qq = (q or "").strip()
-if qq:
-    ql = qq.lower()
-    mask = False
-    if COL_COMMON in df_f.columns:
-        mask = mask | norm_series(df_f[COL_COMMON]).str.contains(ql, na=False)
-    if COL_CAS in df_f.columns:
-        mask = mask | norm_series(df_f[COL_CAS]).str.contains(ql, na=False)
-    df_f = df_f[mask].copy()
-
-df_f = df_f.reset_index(drop=True)
-st.write(f"พบ **{len(df_f):,}** รายการ")
+    total = store.count(q, sources, multi_only)
+    st.write(f"พบ **{total:,}** รายการ")
 
 # -------------------- Pagination --------------------
 c1, c2, c3 = st.columns([1.0, 1.4, 2.6])
 with c1:
     show_per_page = st.selectbox("แสดงต่อหน้า", [10, 20, 30, 50], index=1)
 with c2:
-    total = len(df_f)
     pages = (total - 1) // show_per_page + 1 if total else 1
     page = st.number_input("หน้า", min_value=1, max_value=pages, value=1, step=1)
 with c3:
     st.caption("แสดงแบบ Block ครบทุกข้อมูล (ไม่ต้องกดดูรายละเอียด)")
 
-if len(df_f) == 0:
+if total == 0:
     st.info("ไม่พบข้อมูล")
     st.stop()
 
 start = (page - 1) * show_per_page
-end = min(start + show_per_page, len(df_f))
+if grouped:
+    page_units = units[start:start + show_per_page]
+else:
+    page_units = store.page(q, sources, sort_col, sort_desc, multi_only, start, show_per_page)
 
 st.divider()
 
 # -------------------- Render cards --------------------
-area_col = pick_col(df_f, AREA_COL_CANDIDATES)
-
-for i in range(start, end):
-    row = df_f.iloc[i]
-
-    src = clean_val(row.get("แหล่งข้อมูล", "-"))
-    common = clean_val(row.get(COL_COMMON, "-"))
-    cas = clean_val(row.get(COL_CAS, "-"))
-    chem = clean_val(row.get(COL_CHEM, "-"))
-    maxc = clean_val(row.get(COL_MAXC, "-"))
-    usecase = clean_val(row.get(COL_USECASE, "-"))
-    cond = clean_val(row.get(COL_COND, "-"))
-    order = clean_val(row.get(COL_ORDER, "-"))
-
-    # เฉพาะ allowed เท่านั้น: บริเวณที่ใช้
-    area_val = "-"
-    if src == "วัตถุอาจใช้เป็นส่วนผสม" and area_col is not None:
-        area_val = clean_val(row.get(area_col, "-"))
-
-    title = build_title(common, cas)
+def render_also_in(also_in: tuple[str, ...]) -> None:
+    if also_in:
+        pills = "".join(f'<span class="pill">{src}</span>' for src in also_in)
+        st.markdown(f'<div class="card-subtitle">อยู่ในบัญชีอื่นด้วย: {pills}</div>', unsafe_allow_html=True)
 
+def render_card(card: dict) -> None:
     with st.container(border=True):
         # Title: Common (ไม่ใส่ CAS บนหัว)
-        st.markdown(f'<div class="card-title">{title}</div>', unsafe_allow_html=True)
-
-        # Subtitle: "วัตถุกันเสีย • ลำดับ: 1" (ตัด CAS ออกไป)
-        subtitle_parts = []
-        if src != "-":
-            subtitle_parts.append(src)
-        if order != "-":
-            subtitle_parts.append(f"ลำดับ: {order}")
-        subtitle = " • ".join(subtitle_parts)
-        if subtitle:
-            st.markdown(f'<div class="card-subtitle">{subtitle}</div>', unsafe_allow_html=True)
+        st.markdown(card["title_html"], unsafe_allow_html=True)
+        st.markdown(card["subtitle_html"], unsafe_allow_html=True)
+        render_also_in(card["also_in"])
 
         # Summary row (เพิ่ม CAS เป็นหัวข้อแยก)
         a, b, c, d = st.columns([1.1, 1.1, 1.1, 2.2])
         with a:
             st.markdown('<span class="pill">CAS</span>', unsafe_allow_html=True)
-            st.write(cas)
+            st.write(card["cas"])
         with b:
             st.markdown('<span class="pill">ความเข้มข้นสูงสุด</span>', unsafe_allow_html=True)
-            st.write(maxc)
+            st.write(card["maxc"])
         with c:
             st.markdown('<span class="pill">กรณีที่ใช้</span>', unsafe_allow_html=True)
-            st.write(usecase)
+            st.write(card["usecase"])
         with d:
             st.markdown('<span class="pill">Chemical Name</span>', unsafe_allow_html=True)
-            st.write(chem)
+            st.write(card["chem"])
 
         # เฉพาะ allowed: บริเวณที่ใช้
-        if src == "วัตถุอาจใช้เป็นส่วนผสม" and area_val != "-":
+        if card["area"] != "-":
             st.markdown('<div class="section-title">การนำไปใช้</div>', unsafe_allow_html=True)
-            st.write(area_val)
+            st.write(card["area"])
 
         # เงื่อนไข
         st.markdown('<div class="section-title">เงื่อนไขการใช้งาน</div>', unsafe_allow_html=True)
-        st.write(cond)
+        st.write(card["cond"])
+
+def render_group(g: int, members: list[int]) -> None:
+    # การ์ดเดียวต่อสาร; รายการย่อยสร้างเมื่อกดเปิดเท่านั้น
+    first = load_cards(store, members[:1])[0]
+    if len(members) == 1:
+        render_card(first)
+        return
+    with st.container(border=True):
+        st.markdown(first["title_html"], unsafe_allow_html=True)
+        st.markdown(
+            f'<div class="card-subtitle">{first["source"]} • {len(members)} แบบ</div>',
+            unsafe_allow_html=True,
+        )
+        render_also_in(first["also_in"])
+
+        a, b = st.columns([1.1, 4.4])
+        with a:
+            st.markdown('<span class="pill">CAS</span>', unsafe_allow_html=True)
+            st.write(first["cas"])
+        with b:
+            st.markdown('<span class="pill">Chemical Name</span>', unsafe_allow_html=True)
+            st.write(first["chem"])
+
+        if st.toggle(f"แสดงทั้ง {len(members)} แบบ", key=f"grp-{dataset}-{g}"):
+            for card in load_cards(store, members):
+                render_card(card)
+
+if grouped:
+    load_cards(store, [members[0] for _, members in page_units])  # การ์ดแรกของทุกกลุ่มในหน้า: fetch ครั้งเดียว
+    for g, members in page_units:
+        render_group(g, members)
+else:
+    for card in load_cards(store, page_units):
+        render_card(card)
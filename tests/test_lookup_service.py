@@ -0,0 +1,253 @@
+import http.client
+import json
+import os
+import select
+import socket
+import threading
+import time
+
+import pytest
+
+import lookup_service
+from lookup_service import MAX_BODY, LookupIndex, LookupServer, ResponseCache, bench
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def index():
+    return LookupIndex(ROOT)
+
+
+def start_server(index, **settings):
+    srv = LookupServer(("127.0.0.1", 0), index, workers=2)
+    for name, value in settings.items():
+        setattr(srv, name, value)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def wait_until(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def stop_server(srv):
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture(scope="module")
+def server(index):
+    srv = start_server(index)
+    yield srv
+    stop_server(srv)
+
+
+def connect(server):
+    return http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+
+
+def request(con, method, path, body=None):
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    con.request(method, path, body=body, headers=headers)
+    resp = con.getresponse()
+    return resp.status, json.loads(resp.read())
+
+
+def test_lookup(server):
+    con = connect(server)
+    status, body = request(con, "GET", "/lookup?q=benzoic&limit=2")
+    assert status == 200
+    assert body["total"] == 4
+    assert len(body["results"]) == 2
+    assert body["results"][0]["common"] == "Benzoic acid"
+
+
+@pytest.mark.parametrize(
+    "req",
+    [
+        {"queries": ["acid"], "dataset": ["all"]},
+        {"queries": ["acid"], "dataset": {}},
+        {"queries": ["acid"], "sort": ["conc"]},
+        {"queries": ["acid"], "desc": "yes"},
+        {"queries": ["acid"], "limit": [1]},
+        ["acid"],
+    ],
+)
+def test_batch_rejects_bad_types(server, req):
+    status, body = request(connect(server), "POST", "/batch", json.dumps(req))
+    assert status == 400
+    assert "error" in body
+
+
+def test_batch(server):
+    req = {"queries": ["benzoic", "65-85-0"], "dataset": "preservatives", "sort": "conc", "desc": True, "limit": 1}
+    status, body = request(connect(server), "POST", "/batch", json.dumps(req))
+    assert status == 200
+    assert [len(r["results"]) for r in body["results"]] == [1, 1]
+
+
+def test_unknown_post_keeps_connection_usable(server):
+    con = connect(server)
+    status, _ = request(con, "POST", "/nope", json.dumps({"queries": ["x" * 1000]}))
+    assert status == 404
+    status, body = request(con, "GET", "/health")
+    assert status == 200
+    assert body["status"] == "ok"
+
+
+def test_cache_key_ignores_limit_and_padding(index):
+    cache = ResponseCache(index)
+    body = cache.lookup_json("acid", limit=5)
+    assert cache.lookup_json("  acid ", limit=5) == body
+    assert json.loads(cache.lookup_json("acid", limit=2))["results"] == json.loads(body)["results"][:2]
+    assert len(json.loads(cache.lookup_json("acid", limit=20))["results"]) == 20
+    cache.lookup_json("benzoic", limit=10**6)
+    cache.lookup_json("benzoic", limit=3)
+    cache.lookup_json("benzoic", desc=True)
+    assert len(cache.items) == 2
+
+
+def test_cache_is_bounded_by_bytes(index):
+    cache = ResponseCache(index, max_bytes=20000)
+    for i in range(300):
+        cache.lookup_json("%d" % i, limit=1000)
+    assert 0 < cache.size <= 20000
+    assert cache.size == sum(cache.entry_size(k, e) for k, e in cache.items.items())
+
+
+def test_idle_keepalive_connections_hold_no_worker(server):
+    # more idle keep-alive clients than workers must not stall a new client
+    idle = [connect(server) for _ in range(5)]
+    for con in idle:
+        assert request(con, "GET", "/health")[0] == 200
+    con = connect(server)
+    con.timeout = 2
+    assert request(con, "GET", "/lookup?q=65-85-0")[0] == 200
+    for con in idle:
+        assert request(con, "GET", "/health")[0] == 200
+
+
+def test_pipelined_requests(server):
+    sock = socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=5)
+    sock.sendall(b"GET /health HTTP/1.1\r\nHost: x\r\n\r\n" * 2 + b"GET /health HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+    data = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    assert data.count(b"HTTP/1.1 200") == 3
+
+
+def test_idle_connections_are_closed(index):
+    srv = start_server(index, IDLE_TIMEOUT=0.2)
+    try:
+        sock = socket.create_connection(("127.0.0.1", srv.server_address[1]), timeout=5)
+        t0 = time.monotonic()
+        assert sock.recv(1) == b""
+        assert time.monotonic() - t0 < 4
+    finally:
+        stop_server(srv)
+
+
+def test_connection_cap_drops_longest_idle(index):
+    srv = start_server(index, MAX_CONNECTIONS=2)
+    try:
+        first, second = connect(srv), connect(srv)
+        # a connection is idle (and can be dropped) once its worker has handed it back
+        assert request(first, "GET", "/health")[0] == 200
+        wait_until(lambda: len(srv.idle) == 1)
+        assert request(second, "GET", "/health")[0] == 200
+        wait_until(lambda: len(srv.idle) == 2)
+        assert request(connect(srv), "GET", "/health")[0] == 200
+        assert first.sock.recv(1) == b""
+        assert request(second, "GET", "/health")[0] == 200
+    finally:
+        stop_server(srv)
+
+
+def test_connection_burst_is_accepted_without_syn_retry(server):
+    # more simultaneous connects than socketserver's default backlog of 5
+    n = 64
+    start = threading.Barrier(n)
+    results = []
+
+    def client():
+        start.wait()
+        t0 = time.monotonic()
+        con = connect(server)
+        status, _ = request(con, "GET", "/health")
+        results.append((status, time.monotonic() - t0))
+        con.close()
+
+    threads = [threading.Thread(target=client) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [status for status, _ in results] == [200] * n
+    # a dropped SYN is retried after 1 s
+    assert max(seconds for _, seconds in results) < 0.9
+
+
+def raw_response(sock):
+    data = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_oversized_body_is_rejected_and_closed(server):
+    sock = socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=5)
+    sock.sendall(b"POST /batch HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n" % (MAX_BODY + 1))
+    data = raw_response(sock)  # answered and closed without waiting for the body
+    assert data.startswith(b"HTTP/1.1 413")
+    assert b"Connection: close" in data
+
+
+def test_trickled_body_times_out(server, monkeypatch):
+    monkeypatch.setattr(lookup_service, "BODY_TIMEOUT", 0.3)
+    sock = socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=5)
+    sock.sendall(b"POST /batch HTTP/1.1\r\nHost: x\r\nContent-Length: 100\r\n\r\n")
+    t0 = time.monotonic()
+    for _ in range(20):
+        # stop once the server answers: writing to a closed peer would reset the connection
+        if select.select([sock], [], [], 0.1)[0]:
+            break
+        sock.sendall(b" ")
+    data = raw_response(sock)
+    assert data.startswith(b"HTTP/1.1 408")
+    assert time.monotonic() - t0 < 3
+
+
+def test_internal_error_hides_details(server, monkeypatch, capsys):
+    def boom(*args):
+        raise RuntimeError("secret detail")
+
+    monkeypatch.setattr(server.cache, "lookup_json", boom)
+    status, body = request(connect(server), "GET", "/lookup?q=acid")
+    assert status == 500
+    assert body == {"error": "internal error"}
+    assert "secret detail" in capsys.readouterr().err
+
+
+def test_bench_counts_unreachable_server_as_errors(capsys):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()  # nothing listens here
+    assert bench("http://127.0.0.1:%d" % port, ["acid"], 8, 2) == 1
+    out = capsys.readouterr().out
+    assert "errors 8" in out
+    assert "no request completed" in out
+
+
+def test_bench(server, capsys):
+    assert bench("http://127.0.0.1:%d" % server.server_address[1], ["acid"], 8, 2) is None
+    assert "requests   8 (errors 0)" in capsys.readouterr().out
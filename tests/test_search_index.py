@@ -0,0 +1,235 @@
+import os
+
+import pytest
+
+from search_index import (
+    ALSO_IN_FIELD,
+    COL_CAS,
+    COL_CHEM,
+    COL_COMMON,
+    COL_COND,
+    COL_MAXC,
+    COL_ORDER,
+    DEFAULT_QUERY_FIELDS,
+    CrossIndex,
+    GroupIndex,
+    MemoryStore,
+    QueryIndex,
+    SortIndex,
+    natural_key,
+    parse_concentration,
+    parse_query,
+    read_csv_as_dicts,
+    tokenize_query,
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def rows():
+    out = []
+    for fname in ("preservatives.csv", "allowed.csv"):
+        _, rs = read_csv_as_dicts(os.path.join(ROOT, fname))
+        out.extend(rs)
+    return out
+
+
+@pytest.fixture(scope="module")
+def index(rows):
+    return QueryIndex(rows, ["src"] * len(rows))
+
+
+def substring_match(rows, q):
+    # the search before the query language: whole input as one substring of Common/CAS
+    q = q.strip().lower()
+    return [i for i, r in enumerate(rows) if any(q in (r.get(c) or "").strip().lower() for c in DEFAULT_QUERY_FIELDS)]
+
+
+def test_hyphen_and_parens_inside_name_are_literal():
+    assert tokenize_query("N,N-bis(2-Hydroxyethyl)-p-phenylenediamine sulfate") == [
+        ("term", None, "N,N-bis(2-Hydroxyethyl)-p-phenylenediamine"),
+        ("term", None, "sulfate"),
+    ]
+    assert tokenize_query("(hcl)") == [("term", None, "(hcl)")]
+    assert tokenize_query("x-(y)") == [("term", None, "x-(y)")]
+
+
+def test_cas_numbers_are_not_negated():
+    assert tokenize_query("65-85-0") == [("term", None, "65-85-0")]
+    assert parse_query("cas:65-85-0") == ("term", COL_CAS, "65-85-0")
+
+
+def test_operators_at_word_boundaries():
+    assert parse_query("acid -benzoic") == ("and", [("term", None, "acid"), ("not", ("term", None, "benzoic"))])
+    assert parse_query("-(a OR b)") == ("not", ("or", [("term", None, "a"), ("term", None, "b")]))
+    assert parse_query("(benzoic OR salicylic) AND cond:ปาก") == (
+        "and",
+        [("or", [("term", None, "benzoic"), ("term", None, "salicylic")]), ("term", COL_COND, "ปาก")],
+    )
+
+
+def test_fields_phrases_and_comparisons():
+    assert parse_query('common:"Benzoic  acid"') == ("term", COL_COMMON, "benzoic acid")
+    assert parse_query("conc>=0.5") == ("cmp", ">=", 0.5)
+    assert parse_query("conc:2.5") == ("cmp", "=", 2.5)
+
+
+@pytest.mark.parametrize("q", ["", "   ", "NOT", "cas:", "acid OR", '"open', "((x", ")acid"])
+def test_half_typed_input_never_raises(q):
+    parse_query(q)
+
+
+def test_every_common_name_finds_its_own_row(rows, index):
+    for i, r in enumerate(rows):
+        name = r[COL_COMMON]
+        if name.strip():
+            assert i in index.search(name), name
+
+
+@pytest.mark.parametrize("q", ["benzoic", "65-85-0", "(hcl)", "N,N-bis(2-Hydroxyethyl)-p-phenylenediamine sulfate"])
+def test_bare_input_finds_what_substring_search_found(rows, index, q):
+    assert set(substring_match(rows, q)) <= set(index.search(q))
+
+
+def test_single_word_matches_substring_search(rows, index):
+    for q in ("benzoic", "ac", "a", "65-85-0", "(hcl)"):
+        assert index.search(q) == substring_match(rows, q)
+
+
+def test_order_sorts_naturally():
+    assert sorted(["10", "2", "1a", "1"], key=natural_key) == ["1", "1a", "2", "10"]
+    assert natural_key("") is None
+
+
+@pytest.mark.parametrize(
+    "v, want",
+    [
+        ("2.5%\nคํานวณในรูปกรด", 2.5),
+        ("0,5 %", 0.5),
+        ("100 mg/kg", 0.01),
+        ("50 ppm", 0.005),
+        ("-", None),
+        ("", None),
+        (float("nan"), None),
+    ],
+)
+def test_parse_concentration(v, want):
+    assert parse_concentration(v) == want
+
+
+SORT_ROWS = [
+    {COL_ORDER: "10", COL_CHEM: "beta", COL_MAXC: "0.5%"},
+    {COL_ORDER: "", COL_CHEM: "", COL_MAXC: "-"},
+    {COL_ORDER: "2", COL_CHEM: "Alpha", COL_MAXC: "100 mg/kg"},
+    {COL_ORDER: "1a", COL_CHEM: "gamma", COL_MAXC: "2%"},
+    {COL_ORDER: "1", COL_CHEM: "alpha", COL_MAXC: "0.5%"},
+]
+
+
+@pytest.mark.parametrize(
+    "col, asc, desc",
+    [
+        (COL_ORDER, [4, 3, 2, 0, 1], [0, 2, 3, 4, 1]),
+        # case-insensitive; ties keep file order in both directions
+        (COL_CHEM, [2, 4, 0, 3, 1], [3, 0, 2, 4, 1]),
+        # by parsed value, not text: 100 mg/kg = 0.01%
+        (COL_MAXC, [2, 0, 4, 3, 1], [3, 0, 4, 2, 1]),
+    ],
+)
+def test_sort_index_puts_empty_values_last(col, asc, desc):
+    index = SortIndex(SORT_ROWS, [col])
+    everything = list(range(len(SORT_ROWS)))
+    assert index.sort(everything, col) == asc
+    assert index.sort(everything, col, reverse=True) == desc
+    # a small result set (under a quarter of the rows) goes through the rank path
+    index = SortIndex(SORT_ROWS * 4, [col])
+    assert index.sort([1, 4, 0], col) == [p for p in asc if p in (1, 4, 0)]
+    assert index.sort([1, 4, 0], col, reverse=True) == [p for p in desc if p in (1, 4, 0)]
+
+
+def test_group_index_collapses_a_substance_per_source():
+    rows, sources = [], []
+    for fname, source in (("preservatives.csv", "pres"), ("allowed.csv", "allowed")):
+        _, rs = read_csv_as_dicts(os.path.join(ROOT, fname))
+        rows.extend(rs)
+        sources.extend([source] * len(rs))
+    # the same substance spelled differently, once more in each list
+    rows.append({COL_COMMON: " benzoic  ACID ", COL_CAS: "65-85-0"})
+    sources.append("pres")
+    rows.append({COL_COMMON: "Benzoic acid", COL_CAS: "65-85-0"})
+    sources.append("allowed")
+
+    groups = GroupIndex(rows, sources)
+    benzoic = [i for i, r in enumerate(rows) if "65-85-0" in str(r.get(COL_CAS))]
+    by_source = {}
+    for i in benzoic:
+        by_source.setdefault(sources[i], set()).add(groups.group_of[i])
+    assert len(by_source["pres"]) == 1
+    assert len(by_source["allowed"]) == 1
+    assert by_source["pres"] != by_source["allowed"]
+    (g,) = by_source["pres"]
+    assert groups.members[g] == [i for i in benzoic if sources[i] == "pres"]
+    assert len(groups.members[g]) == 4
+
+    # group() keeps groups in order of their first hit and members in hit order
+    other = next(i for i in range(len(rows)) if i not in benzoic)
+    h = groups.group_of[other]
+    assert groups.group([benzoic[2], other, benzoic[0]]) == [
+        (g, [benzoic[2], benzoic[0]]),
+        (h, [other]),
+    ]
+
+
+def test_group_index_leaves_rows_without_cas_and_name_alone():
+    rows = [
+        {COL_CHEM: "Unnamed extract", COL_COMMON: "-", COL_CAS: "-"},
+        {COL_CHEM: "Unnamed extract", COL_COMMON: "", COL_CAS: ""},
+        {COL_CHEM: "Unnamed extract"},
+        {COL_COMMON: "Water", COL_CAS: "-"},
+        {COL_COMMON: "water", COL_CAS: ""},
+    ]
+    groups = GroupIndex(rows, ["pres"] * len(rows))
+    assert groups.group_of == [0, 1, 2, 3, 3]
+    assert groups.members == [[0], [1], [2], [3, 4]]
+    assert groups.group(range(len(rows))) == [(0, [0]), (1, [1]), (2, [2]), (3, [3, 4])]
+
+
+PRESERVATIVES = [
+    {COL_COMMON: "Benzoic acid", COL_CAS: "65-85-0"},
+    {COL_COMMON: "Sorbic acid", COL_CAS: "-"},
+    {COL_COMMON: "Phenoxyethanol", COL_CAS: "122-99-6"},
+]
+ALLOWED = [
+    # same CAS, different Common name
+    {COL_COMMON: "Benzoate (acid form)", COL_CAS: "65-85-0/\n532-32-1"},
+    # same Common name, no CAS
+    {COL_COMMON: "sorbic  ACID", COL_CAS: ""},
+    {COL_COMMON: "Glycerin", COL_CAS: "56-81-5"},
+]
+
+
+def test_cross_index_links_by_cas_and_by_name():
+    rows = PRESERVATIVES + ALLOWED
+    sources = ["pres"] * 3 + ["allowed"] * 3
+    links = CrossIndex(rows, sources)
+    assert links.also_in == [
+        ("allowed",),
+        ("allowed",),
+        (),
+        ("pres",),
+        ("pres",),
+        (),
+    ]
+
+
+def test_multi_only_keeps_linked_rows():
+    store = MemoryStore([
+        ("pres", [COL_COMMON, COL_CAS], [dict(r) for r in PRESERVATIVES]),
+        ("allowed", [COL_COMMON, COL_CAS], [dict(r) for r in ALLOWED]),
+    ])
+    assert store.select("") == [0, 1, 2, 3, 4, 5]
+    assert store.select("", multi_only=True) == [0, 1, 3, 4]
+    assert store.select("", ["allowed"], multi_only=True) == [3, 4]
+    assert store.count("acid", multi_only=True) == 4
+    assert [r[ALSO_IN_FIELD] for r in store.fetch([0, 2, 3])] == [("allowed",), (), ("pres",)]
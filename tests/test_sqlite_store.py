@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+from search_index import (
+    ALSO_IN_FIELD,
+    COL_CAS,
+    COL_COMMON,
+    COL_MAXC,
+    SORT_COLUMNS,
+    SOURCE_FIELD,
+    MemoryStore,
+    read_csv_as_dicts,
+)
+from sqlite_store import SqliteStore, build_store, ensure_store
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FILES = [
+    (os.path.join(ROOT, "preservatives.csv"), "วัตถุกันเสีย"),
+    (os.path.join(ROOT, "allowed.csv"), "วัตถุอาจใช้เป็นส่วนผสม"),
+]
+
+QUERIES = [
+    "",
+    "benzoic",
+    "65-85-0",
+    "acid",
+    "ac",
+    "cas:50-00-0",
+    'common:"salicylic acid"',
+    "acid conc>1",
+    "conc<=0.5",
+    "conc:2.5",
+    "NOT conc>1",
+    "acid NOT chem:sodium",
+    "-acid",
+    "benzoic OR salicylic",
+    "(benzoic OR sorbic) conc>=0.5",
+    "source:กันเสีย",
+    "use:อาจใช้",
+    "zzz-no-such-thing",
+]
+
+
+@pytest.fixture(scope="module")
+def memory():
+    return MemoryStore([(source,) + read_csv_as_dicts(path) for path, source in FILES])
+
+
+@pytest.fixture(scope="module")
+def sqlite(tmp_path_factory):
+    db = str(tmp_path_factory.mktemp("store") / "search.db")
+    build_store(db, FILES)
+    return SqliteStore(db)
+
+
+@pytest.mark.parametrize("q", QUERIES)
+def test_search_matches_memory(memory, sqlite, q):
+    assert sqlite.search(q) == memory.search(q)
+
+
+@pytest.mark.parametrize("q", ["", "acid", "conc>0.1"])
+@pytest.mark.parametrize("col", SORT_COLUMNS)
+@pytest.mark.parametrize("desc", [False, True])
+def test_sort_matches_memory(memory, sqlite, q, col, desc):
+    assert sqlite.select(q, sort=col, desc=desc) == memory.select(q, sort=col, desc=desc)
+
+
+@pytest.mark.parametrize("q", ["", "acid"])
+def test_filters_and_pages_match_memory(memory, sqlite, q):
+    for sources in ([FILES[0][1]], [FILES[1][1]], None):
+        for multi_only in (False, True):
+            args = (q, sources, COL_MAXC, True, multi_only)
+            assert sqlite.select(*args) == memory.select(*args)
+            assert sqlite.count(q, sources, multi_only) == memory.count(q, sources, multi_only)
+            assert sqlite.page(*args, offset=5, limit=10) == memory.page(*args, offset=5, limit=10)
+
+
+def test_groups_and_rows_match_memory(memory, sqlite):
+    ids = memory.select("acid", sort=COL_COMMON)
+    assert sqlite.groups(ids) == memory.groups(ids)
+    for want, got in zip(memory.fetch(ids), sqlite.fetch(ids)):
+        assert got == want
+    assert any(r[ALSO_IN_FIELD] for r in sqlite.fetch(sqlite.select("", multi_only=True)))
+
+
+def test_store_metadata_matches_memory(memory, sqlite):
+    assert sqlite.sources == memory.sources
+    assert sqlite.counts == memory.counts
+    assert sqlite.headers == memory.headers
+    row = sqlite.fetch([0])[0]
+    assert row[SOURCE_FIELD] == FILES[0][1]
+    assert set([COL_CAS, COL_COMMON]) <= set(row)
+
+
+def test_ensure_store_rebuilds_only_when_stale(tmp_path):
+    db = str(tmp_path / "search.db")
+    ensure_store(db, FILES)
+    mtime = os.stat(db).st_mtime_ns
+    ensure_store(db, FILES)
+    assert os.stat(db).st_mtime_ns == mtime
+    ensure_store(db, FILES[:1])
+    assert SqliteStore(db).sources == [FILES[0][1]]
+
+
+def test_conc_comparison_can_use_index(sqlite):
+    where, params = sqlite._where("conc>1", None, False)
+    plan = sqlite.reader.connect().execute("EXPLAIN QUERY PLAN SELECT count(*) FROM rows WHERE " + where, params)
+    assert any("rows_conc" in row[-1] for row in plan)